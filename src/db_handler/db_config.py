@@ -5,12 +5,18 @@
 #
 # It is assumed that credentials are set via environment
 # variables.
+#
+# Connections are handed out by a shared sync and async
+# pool (psycopg_pool), so the decorators below no longer
+# pay a connect/disconnect on every call.
 ############################################################
 import os
+import time
 
 from rich.console import Console
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
 
 # Create rich console instance:
 console = Console()
@@ -31,19 +37,99 @@ def pg_credentials() -> dict:
     }
 
 
+def pool_settings() -> dict:
+    """Dictionary of the connection pool settings. Each value can be
+    overridden with an environment variable.
+    :return: dictionary of pool settings."""
+    return {
+        # Connections kept open even when idle:
+        "min_size": int(os.environ.get("PG_POOL_MIN_SIZE", 2)),
+        # Upper bound on connections open at the same time:
+        "max_size": int(os.environ.get("PG_POOL_MAX_SIZE", 10)),
+        # Seconds a connection above min_size may sit idle before it is closed:
+        "max_idle": float(os.environ.get("PG_POOL_MAX_IDLE", 300)),
+        # Seconds after which a connection is replaced, whatever its state:
+        "max_lifetime": float(os.environ.get("PG_POOL_MAX_LIFETIME", 3600)),
+        # Seconds between health checks of the idle connections:
+        "check_interval": float(os.environ.get("PG_POOL_CHECK_INTERVAL", 60)),
+    }
+
+
 class DbConnection:
-    """Decorators for handling connections to postgres container."""
+    """Decorators for handling connections to postgres container.
+
+    All decorators borrow their connection from a shared pool; the sync
+    decorators use `ConnectionPool` and the async ones `AsyncConnectionPool`.
+    Pools are created lazily on first use (the async pool needs a running
+    event loop) and closed with `close_pools`. Since pooled connections
+    stay open, statements executed with `prepare=True` are parsed and
+    planned once per connection rather than on every call."""
     params = pg_credentials()
+    settings = pool_settings()
+    _pool = None
+    _async_pool = None
+    _last_check = 0.0
+    _last_async_check = 0.0
+
+    @staticmethod
+    def get_pool() -> ConnectionPool:
+        """Returns the shared sync pool, creating it on first call. Idle
+        connections are health checked every `check_interval` seconds."""
+        settings = DbConnection.settings
+        if DbConnection._pool is None:
+            DbConnection._pool = ConnectionPool(
+                kwargs=DbConnection.params,
+                min_size=settings["min_size"],
+                max_size=settings["max_size"],
+                max_idle=settings["max_idle"],
+                max_lifetime=settings["max_lifetime"],
+                name="tweeasy",
+            )
+            DbConnection._last_check = time.monotonic()
+        elif time.monotonic() - DbConnection._last_check > settings["check_interval"]:
+            DbConnection._last_check = time.monotonic()
+            DbConnection._pool.check()
+        return DbConnection._pool
+
+    @staticmethod
+    async def get_async_pool() -> AsyncConnectionPool:
+        """Returns the shared async pool, creating it on first call. Idle
+        connections are health checked every `check_interval` seconds."""
+        settings = DbConnection.settings
+        if DbConnection._async_pool is None:
+            DbConnection._async_pool = AsyncConnectionPool(
+                kwargs=DbConnection.params,
+                min_size=settings["min_size"],
+                max_size=settings["max_size"],
+                max_idle=settings["max_idle"],
+                max_lifetime=settings["max_lifetime"],
+                name="tweeasy-async",
+            )
+            DbConnection._last_async_check = time.monotonic()
+        elif time.monotonic() - DbConnection._last_async_check > settings["check_interval"]:
+            DbConnection._last_async_check = time.monotonic()
+            await DbConnection._async_pool.check()
+        return DbConnection._async_pool
+
+    @staticmethod
+    async def close_pools() -> None:
+        """Closes both pools, if they were opened."""
+        if DbConnection._pool is not None:
+            DbConnection._pool.close()
+            DbConnection._pool = None
+        if DbConnection._async_pool is not None:
+            await DbConnection._async_pool.close()
+            DbConnection._async_pool = None
 
     def with_connection(func):
         """Decorator for handling non-async connection.
 
         The psycopg connection cursor's row_factory is set to work with
         dictionaries."""
-        params = pg_credentials()
 
         def wrapper(self, *args, **kwargs):
-            conn = psycopg.connect(**params)
+            pool = DbConnection.get_pool()
+            conn = pool.getconn()
             # To make working with Pydantic a little more straightforward,
             # we'll set the row_factory to work with dicts
             cur = conn.cursor(row_factory=dict_row)
@@ -56,7 +142,7 @@ class DbConnection:
             else:
                 conn.commit()
             finally:
-                conn.close()
+                pool.putconn(conn)
             return res
 
         return wrapper
@@ -66,10 +152,10 @@ class DbConnection:
 
         The psycopg connection cursor's row_factory is set to work with
         dictionaries."""
-        params = pg_credentials()
 
         async def async_wrapper(self, *args, **kwargs):
-            conn = await psycopg.AsyncConnection.connect(**params)
+            pool = await DbConnection.get_async_pool()
+            conn = await pool.getconn()
             # To make working with Pydantic a little more straightforward,
             # we'll set the row_factory to work with dicts
             cur = conn.cursor(row_factory=dict_row)
@@ -82,7 +168,7 @@ class DbConnection:
             else:
                 await conn.commit()
             finally:
-                await conn.close()
+                await pool.putconn(conn)
             return res
 
         return async_wrapper
@@ -91,7 +177,8 @@ class DbConnection:
         """Decorator for handling cursor.copy() STDIN/STDOUT"""
 
         def wrapper(self, *args, **kwargs):
-            conn = psycopg.connect(**DbConnection.params)
+            pool = DbConnection.get_pool()
+            conn = pool.getconn()
             try:
                 res = func(self, conn, *args, **kwargs)
             except Exception as e:
@@ -101,7 +188,7 @@ class DbConnection:
             else:
                 conn.commit()
             finally:
-                conn.close()
+                pool.putconn(conn)
             return res
 
         return wrapper
@@ -109,11 +196,11 @@ class DbConnection:
     def with_async_copy(func):
         """Decorator for handling async cursor.copy() STDIN/STDOUT.
         Passes connection to function."""
-        params = pg_credentials()
 
         async def async_wrapper(self, *args, **kwargs):
             res = None
-            conn = await psycopg.AsyncConnection.connect(**params)
+            pool = await DbConnection.get_async_pool()
+            conn = await pool.getconn()
             await conn.set_autocommit(True)
             try:
                 res = await func(self, conn, *args, **kwargs)
@@ -121,10 +208,12 @@ class DbConnection:
                 console.log(e)
                 await conn.rollback()
                 raise
-            else:
-                await conn.close()
             finally:
-                await conn.close()
+                # Pooled connections are shared, so hand it back in
+                # the same state we found it:
+                if not conn.closed:
+                    await conn.set_autocommit(False)
+                await pool.putconn(conn)
             return res
 
         return async_wrapper
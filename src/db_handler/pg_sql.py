@@ -1,7 +1,7 @@
 ############################################################
 # File for all of our SQL statements.
 ############################################################
-from typing import Tuple
+from typing import Tuple, Union
 from utils.logger import log, logger
 
 
@@ -36,9 +36,48 @@ def create_users_or_follower_table(table_name: str) -> str:
                 statuses_count INT,
                 status JSON,
                 withheld_in_countries TEXT,
-                collected TIMESTAMPTZ);
+                collected TIMESTAMPTZ);"""
 
-    CREATE INDEX ON {table_name} ({user_id});"""
+
+def create_screen_name_index() -> str:
+    """SQL for the index behind case-insensitive screen name lookups
+    on the users table."""
+    return """
+    CREATE INDEX IF NOT EXISTS users_screen_name_lower_idx ON users (LOWER(screen_name));"""
+
+
+def create_collected_index(table_name: str) -> str:
+    """SQL for a BRIN index on the `collected` column of <table_name>. Rows
+    are appended roughly in `collected` order, so a BRIN index covers it at
+    a fraction of the size and upkeep of a B-tree."""
+    return f"""
+    CREATE INDEX IF NOT EXISTS {table_name}_collected_brin_idx ON {table_name} USING BRIN (collected);"""
+
+
+def get_redundant_indexes(table: str) -> str:
+    """SQL for the plain indexes of <table> that cover exactly the same
+    columns as its primary key, which already has an index of its own.
+    :param table: the name of the table to check"""
+    return f"""
+        SELECT
+            i.indexrelid::regclass::text AS index_name
+        FROM
+            pg_index i
+        JOIN
+            pg_index pk ON pk.indrelid = i.indrelid AND pk.indisprimary
+        WHERE
+            i.indrelid = to_regclass('public.{table}')
+            AND NOT i.indisprimary
+            AND NOT i.indisunique
+            AND i.indkey::text = pk.indkey::text
+            AND i.indexprs IS NULL
+            AND i.indpred IS NULL;"""
+
+
+def drop_index(index_name: str) -> str:
+    """SQL for deleting an index.
+    :param index_name: the name of the index you want to drop."""
+    return f"DROP INDEX IF EXISTS {index_name};"
 
 
 def create_join_table(
@@ -57,6 +96,7 @@ def create_join_table(
             id SERIAL PRIMARY KEY,
             {second_table[1]} BIGINT,
             {first_table[1]} BIGINT,
+            valid_from TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY 
                 ({second_table[1]})
             REFERENCES 
@@ -71,6 +111,144 @@ def create_join_table(
         CREATE INDEX ON {table_name} ({second_table[1]}, {first_table[1]});"""
 
 
+def create_partitioned_join_table(table_name: str, partitions: int) -> str:
+    """SQL for creating the join table hash-partitioned on user_id, without
+    keys, so it can be bulk loaded before `add_join_table_keys` is run.
+    :param table_name: the name you want assigned to the join table.
+    :param partitions: number of hash partitions.
+    :return: sql for query
+    """
+    partitions_sql = "".join(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table_name}_p{i}
+            PARTITION OF {table_name}
+            FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i});"""
+        for i in range(partitions)
+    )
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            follower_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            valid_from TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY HASH (user_id);{partitions_sql}"""
+
+
+def add_join_table_keys(table_name: str, deferred: bool = False) -> str:
+    """SQL for adding the natural primary key and the foreign keys of the
+    partitioned join table. Adding them to a loaded table checks all rows
+    in one pass each.
+    :param table_name: name of the join table.
+    :param deferred: whether the foreign keys are only checked at commit.
+    :return: sql for query
+    """
+    deferrable = "DEFERRABLE INITIALLY DEFERRED" if deferred else ""
+    return f"""
+        ALTER TABLE {table_name}
+            ADD PRIMARY KEY (user_id, follower_id),
+            ADD FOREIGN KEY
+                (follower_id)
+            REFERENCES
+                followers(follower_id)
+            ON DELETE CASCADE {deferrable},
+            ADD FOREIGN KEY
+                (user_id)
+            REFERENCES
+                users(user_id)
+            ON DELETE CASCADE {deferrable};"""
+
+
+def check_table_partitioned(table: str) -> str:
+    """SQL for checking whether a table is partitioned.
+    :param table: the name of the table to check"""
+    return f"""
+        SELECT
+            relkind = 'p' AS partitioned
+        FROM
+            pg_class
+        WHERE
+            oid = to_regclass('public.{table}');"""
+
+
+def rename_table(table: str, new_name: str) -> str:
+    """SQL for renaming <table> to <new_name>."""
+    return f"ALTER TABLE {table} RENAME TO {new_name};"
+
+
+def analyze_table(table: str) -> str:
+    """SQL for refreshing the planner statistics of <table>."""
+    return f"ANALYZE {table};"
+
+
+def copy_join_rows(from_table: str, to_table: str) -> str:
+    """SQL for copying the distinct, complete (follower_id, user_id) rows of
+    one join table into another. Of duplicate joins, the earliest is kept."""
+    return f"""
+        INSERT INTO {to_table} (follower_id, user_id, valid_from)
+        SELECT DISTINCT ON (user_id, follower_id)
+            follower_id, user_id, valid_from
+        FROM
+            {from_table}
+        WHERE
+            follower_id IS NOT NULL
+            AND user_id IS NOT NULL
+        ORDER BY
+            user_id, follower_id, valid_from;"""
+
+
+def add_join_valid_from_column(table_name: str) -> str:
+    """SQL for adding the `valid_from` column to a join table created
+    without it. Existing joins are left with no `valid_from`, as it is
+    unknown when they started."""
+    return f"""
+        ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS valid_from TIMESTAMPTZ;
+        ALTER TABLE {table_name}
+            ALTER COLUMN valid_from SET DEFAULT CURRENT_TIMESTAMP;"""
+
+
+def create_join_history_table() -> str:
+    """SQL for the table of ended joins (unfollows). A join that ends is
+    moved here from users_followers with the time it was seen to end, so
+    users_followers only holds current joins and a follower who comes back
+    gets a new join there while the old one is kept here."""
+    return """
+        CREATE TABLE IF NOT EXISTS users_followers_history (
+            follower_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            valid_from TIMESTAMPTZ,
+            valid_to TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY
+                (follower_id)
+            REFERENCES
+                followers(follower_id)
+            ON DELETE CASCADE,
+            FOREIGN KEY
+                (user_id)
+            REFERENCES
+                users(user_id)
+            ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS users_followers_history_user_id_idx
+            ON users_followers_history (user_id, follower_id);"""
+
+
+def create_checkpoint_table() -> str:
+    """SQL for the table holding the cursor position of unfinished follower
+    id crawls, one row per user, so a crawl can resume after a restart."""
+    return """
+        CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+            user_id BIGINT PRIMARY KEY,
+            next_cursor BIGINT NOT NULL,
+            ids_collected BIGINT NOT NULL DEFAULT 0,
+            updated TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY
+                (user_id)
+            REFERENCES
+                users(user_id)
+            ON DELETE CASCADE
+        );"""
+
+
 def get_all_tables():
     return f"""
     SELECT 
@@ -78,7 +256,9 @@ def get_all_tables():
     FROM 
         pg_catalog.pg_tables
     WHERE
-        schemaname = 'public';"""
+        schemaname = 'public'
+        -- Partitions are dropped along with their table:
+        AND tablename NOT IN (SELECT inhrelid::regclass::text FROM pg_inherits);"""
 
 
 def check_table_exists(table: str) -> str:
@@ -87,18 +267,31 @@ def check_table_exists(table: str) -> str:
     return f"SELECT to_regclass('public.{table}');"
 
 
-def check_user_exists(username: str, table: str) -> str:
-    """SQL for checking that a user exists in
-    the database.
-    :param username: name of the user to check.
+def check_column_exists() -> str:
+    """SQL for checking that the column given as second parameter exists
+    in the table given as first parameter."""
+    return """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'public'
+            AND table_name = %s
+            AND column_name = %s
+        ) AS exists;"""
+
+
+def check_user_exists(table: str) -> str:
+    """SQL for checking that a user, whose name is given as parameter,
+    exists in the database. The name is matched ignoring case. Error
+    handling for incorrect table specification should be done by the caller.
     :param table: name of the table to check."""
     return f"""
-        SELECT 
-            *
+        SELECT
+            1
         FROM
             {table}
         WHERE
-            screen_name = '{username}';"""
+            LOWER(screen_name) = LOWER(%s)
+        LIMIT 1;"""
 
 
 def drop_table(table: str) -> str:
@@ -119,40 +312,70 @@ def get_table_row_count(table: str) -> str:
             {table};"""
 
 
-def get_current_timestamp() -> str:
-    """SQL for getting the current timestamp from the database."""
-    return "SELECT CURRENT_TIMESTAMP;"
-
-
-def get_all_users_followers(user_id: int) -> str:
-    """SQL for grabbing all data from the join table users_followers."""
-    return f"""
-        SELECT 
-            follower_id
+def get_checkpoint() -> str:
+    """SQL for the checkpoint of the user given as parameter."""
+    return """
+        SELECT
+            next_cursor,
+            ids_collected,
+            updated
         FROM
-            users_followers
+            crawl_checkpoints
         WHERE
-            user_id = {user_id};"""
+            user_id = %s;"""
 
 
-def get_all_follower_ids() -> str:
-    """SQL fro grabbing all rows in follower_id column of followers table."""
+def upsert_checkpoint() -> str:
+    """SQL for saving the checkpoint of a user. Parameters: user_id,
+    next_cursor, ids_collected."""
     return """
-        SELECT
-            follower_id
-        FROM
-            followers;"""
+        INSERT INTO crawl_checkpoints (user_id, next_cursor, ids_collected)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            next_cursor = EXCLUDED.next_cursor,
+            ids_collected = EXCLUDED.ids_collected,
+            updated = CURRENT_TIMESTAMP;"""
+
+
+def delete_checkpoint() -> str:
+    """SQL for removing the checkpoint of the user given as parameter."""
+    return "DELETE FROM crawl_checkpoints WHERE user_id = %s;"
 
 
-def get_users_row(username=None) -> str:
-    """SQL for grabbing all columns in users table for specified user"""
+def get_current_timestamp() -> str:
+    """SQL for getting the current timestamp from the database."""
+    return "SELECT CURRENT_TIMESTAMP;"
+
+
+def copy_out_users_followers(user_id: int) -> str:
+    """SQL for copying the ids of <user_id>'s followers out of the join table
+    users_followers in binary format, sorted and without duplicates so they
+    can be loaded straight into an IdSet. COPY can't take parameters, so
+    <user_id> is interpolated, as an int."""
     return f"""
+        COPY (
+            SELECT DISTINCT
+                follower_id
+            FROM
+                users_followers
+            WHERE
+                user_id = {int(user_id)}
+                AND follower_id IS NOT NULL
+            ORDER BY
+                follower_id
+        ) TO STDOUT (FORMAT BINARY);"""
+
+
+def get_users_row() -> str:
+    """SQL for grabbing all columns in users table for the user whose name
+    is given as parameter, ignoring case."""
+    return """
         SELECT
             *
         FROM
             users
         WHERE
-            LOWER(screen_name) = '{username}';"""
+            LOWER(screen_name) = LOWER(%s);"""
 
 
 def insert_user_data(table: str) -> str:
@@ -195,26 +418,252 @@ def insert_user_data(table: str) -> str:
 
 
 def update_join_table() -> str:
-    """SQL for updating the join table."""
+    """SQL for updating the join table, unless the join already exists."""
     return f"""
         INSERT INTO users_followers (
             follower_id, 
             user_id
         )
-        VALUES (%s, %s);
+        VALUES (%s, %s)
+        ON CONFLICT DO NOTHING;
     """
 
 
-def copy_in_ids() -> str:
-    return "COPY followers (follower_id) FROM STDIN (FORMAT TEXT);"
+def copy_in_lookup_users(table_name: str = "followers") -> str:
+    """SQL for copying user rows (see `formatters.user_row`) into
+    <table_name>: users || followers"""
+    user_id = "user_id" if table_name == "users" else "follower_id"
+    return f"""
+        COPY {table_name} (
+            {user_id},
+            name,
+            screen_name,
+            location,
+            description,
+            url,
+            entities,
+            protected,
+            followers_count,
+            friends_count,
+            listed_count,
+            created_at,
+            favorites_count,
+            verified,
+            statuses_count,
+            status,
+            withheld_in_countries,
+            collected
+        ) FROM STDIN;"""
+
+
+def create_staged_ids_table() -> str:
+    """SQL for the per-connection staging table used to dedup follower ids
+    on the server. Rows are cleared at the end of every transaction."""
+    return """
+        CREATE TEMP TABLE IF NOT EXISTS staged_ids (
+            follower_id BIGINT
+        ) ON COMMIT DELETE ROWS;"""
+
+
+def copy_in_staged_ids() -> str:
+    return "COPY staged_ids (follower_id) FROM STDIN;"
 
 
-def copy_in_join_table() -> str:
-    return "COPY users_followers (follower_id, user_id) FROM STDIN;"
+def select_new_follower_ids() -> str:
+    """SQL for the staged ids that don't exist in the followers table."""
+    return """
+        SELECT
+            s.follower_id
+        FROM
+            staged_ids s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM followers f
+            WHERE f.follower_id = s.follower_id);"""
 
 
-def copy_in_lookup_users(table_name: str = "followers") -> str:
-    return f"COPY {table_name} FROM STDIN;"
+def select_new_join_ids() -> str:
+    """SQL for the staged ids not yet joined to the user given as parameter."""
+    return """
+        SELECT
+            s.follower_id
+        FROM
+            staged_ids s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM users_followers uf
+            WHERE uf.user_id = %s
+            AND uf.follower_id = s.follower_id);"""
+
+
+def insert_staged_ids() -> str:
+    """SQL for moving staged ids into the followers table. Returns the
+    ids that were actually inserted."""
+    return """
+        INSERT INTO followers (follower_id)
+        SELECT follower_id FROM staged_ids
+        ON CONFLICT DO NOTHING
+        RETURNING follower_id;"""
+
+
+def insert_staged_joins() -> str:
+    """SQL for joining staged ids to the user given as parameter, skipping
+    joins that already exist, including any made by another crawl since
+    the check (caught by the primary key of the partitioned layout).
+    Returns the follower ids that were joined."""
+    return """
+        INSERT INTO users_followers (follower_id, user_id)
+        SELECT DISTINCT s.follower_id, %s FROM staged_ids s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM users_followers uf
+            WHERE uf.user_id = %s
+            AND uf.follower_id = s.follower_id)
+        ON CONFLICT DO NOTHING
+        RETURNING follower_id;"""
+
+
+def close_staged_joins() -> str:
+    """SQL for ending the joins of the staged ids to the user given as
+    parameter, i.e. recording that they unfollowed: the joins are moved
+    from users_followers to users_followers_history. Returns the follower
+    ids whose join was ended."""
+    return """
+        WITH ended AS (
+            DELETE FROM users_followers uf
+            USING staged_ids s
+            WHERE uf.user_id = %s
+            AND uf.follower_id = s.follower_id
+            RETURNING uf.follower_id, uf.user_id, uf.valid_from
+        )
+        INSERT INTO users_followers_history (follower_id, user_id, valid_from)
+        SELECT DISTINCT ON (follower_id)
+            follower_id, user_id, valid_from
+        FROM
+            ended
+        ORDER BY
+            follower_id, valid_from
+        RETURNING follower_id;"""
+
+
+def select_stale_follower_ids() -> str:
+    """SQL for the staged ids whose profile in the followers table was never
+    looked up, or was looked up before the number of days given as parameter."""
+    return """
+        SELECT
+            s.follower_id
+        FROM
+            staged_ids s
+        JOIN
+            followers f ON f.follower_id = s.follower_id
+        WHERE
+            f.collected IS NULL
+            OR f.collected < CURRENT_TIMESTAMP - %s * INTERVAL '1 day';"""
+
+
+def create_staged_users_table() -> str:
+    """SQL for the per-connection staging table used to upsert looked up
+    profiles into the followers table. Rows are cleared at the end of
+    every transaction."""
+    return """
+        CREATE TEMP TABLE IF NOT EXISTS staged_users (
+            LIKE followers INCLUDING DEFAULTS
+        ) ON COMMIT DELETE ROWS;"""
+
+
+def insert_staged_users(upsert: bool = False) -> str:
+    """SQL for moving staged profiles into the followers table. Followers
+    already there are skipped, or with <upsert> have their profile
+    overwritten."""
+    if not upsert:
+        on_conflict = "ON CONFLICT (follower_id) DO NOTHING"
+    else:
+        on_conflict = """ON CONFLICT (follower_id) DO UPDATE SET
+            name = EXCLUDED.name,
+            screen_name = EXCLUDED.screen_name,
+            location = EXCLUDED.location,
+            description = EXCLUDED.description,
+            url = EXCLUDED.url,
+            entities = EXCLUDED.entities,
+            protected = EXCLUDED.protected,
+            followers_count = EXCLUDED.followers_count,
+            friends_count = EXCLUDED.friends_count,
+            listed_count = EXCLUDED.listed_count,
+            created_at = EXCLUDED.created_at,
+            favorites_count = EXCLUDED.favorites_count,
+            verified = EXCLUDED.verified,
+            statuses_count = EXCLUDED.statuses_count,
+            status = EXCLUDED.status,
+            withheld_in_countries = EXCLUDED.withheld_in_countries,
+            collected = EXCLUDED.collected"""
+    return f"""
+        INSERT INTO followers (
+            follower_id,
+            name,
+            screen_name,
+            location,
+            description,
+            url,
+            entities,
+            protected,
+            followers_count,
+            friends_count,
+            listed_count,
+            created_at,
+            favorites_count,
+            verified,
+            statuses_count,
+            status,
+            withheld_in_countries,
+            collected
+        )
+        SELECT
+            follower_id,
+            name,
+            screen_name,
+            location,
+            description,
+            url,
+            entities,
+            protected,
+            followers_count,
+            friends_count,
+            listed_count,
+            created_at,
+            favorites_count,
+            verified,
+            statuses_count,
+            status,
+            withheld_in_countries,
+            collected
+        FROM
+            staged_users
+        {on_conflict};"""
+
+
+def create_staged_joins_table() -> str:
+    """SQL for the per-connection staging table used to load buffered
+    (follower_id, user_id) rows into the join table. Rows are cleared at
+    the end of every transaction."""
+    return """
+        CREATE TEMP TABLE IF NOT EXISTS staged_joins (
+            follower_id BIGINT,
+            user_id BIGINT
+        ) ON COMMIT DELETE ROWS;"""
+
+
+def copy_in_staged_joins() -> str:
+    return "COPY staged_joins (follower_id, user_id) FROM STDIN;"
+
+
+def insert_staged_join_rows() -> str:
+    """SQL for moving staged (follower_id, user_id) rows into the join
+    table, skipping joins that already exist."""
+    return """
+        INSERT INTO users_followers (follower_id, user_id)
+        SELECT DISTINCT s.follower_id, s.user_id FROM staged_joins s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM users_followers uf
+            WHERE uf.user_id = s.user_id
+            AND uf.follower_id = s.follower_id)
+        ON CONFLICT DO NOTHING;"""
 
 
 def copy_all_follower_ids() -> str:
@@ -222,17 +671,33 @@ def copy_all_follower_ids() -> str:
     return "COPY followers (follower_id) TO STDOUT;"
 
 
-def copy_out_user_sn() -> str:
-    """SQL for copying just the username from the users table."""
-    return "COPY users (screen_name) TO STDOUT;"
-
-
 def copy_out_ids(table_name) -> str:
-    """SQL for copying just the username from the users table."""
+    """SQL for copying just the ids from <table_name> in binary format,
+    sorted so they can be loaded straight into an IdSet."""
     ids = "follower_id" if table_name == "followers" else "user_id"
-    return f"COPY {table_name} ({ids}) TO STDOUT;"
+    return f"COPY (SELECT {ids} FROM {table_name} ORDER BY {ids}) TO STDOUT (FORMAT BINARY);"
+
+
+def select_for_export(table_name: str, user_id: Union[int, None] = None) -> str:
+    """SQL selecting the rows of <table_name> to export: all of them, or
+    only those related to <user_id> (its followers, for the followers
+    table). COPY can't take parameters, so <user_id> is interpolated, as
+    an int."""
+    if user_id is None:
+        return f"SELECT * FROM {table_name}"
+    if table_name == "followers":
+        return f"""
+        SELECT
+            f.*
+        FROM
+            followers f
+        JOIN
+            users_followers uf ON uf.follower_id = f.follower_id
+        WHERE
+            uf.user_id = {int(user_id)}"""
+    return f"SELECT * FROM {table_name} WHERE user_id = {int(user_id)}"
 
 
-def copy_out_all(table_name) -> str:
-    """SQL for copying all columns and rows from <table_name>"""
-    return f"COPY {table_name} TO STDOUT;"
+def copy_out_query(query: str) -> str:
+    """SQL for copying the result of <query> out as tab separated text."""
+    return f"COPY ({query}) TO STDOUT;"
@@ -8,18 +8,24 @@
 # preference, since right now there is no out-of-the-box
 # compatibility with SQLAlchemy and Psycopg3.
 ############################################################
+import os
 import asyncio
 import json
 import time
 import logging
-from typing import Set, Union, List
+import threading
+from collections import OrderedDict
+from typing import Dict, Set, Union, List, Tuple, Iterable, Iterator
 
 import psycopg
+from psycopg.copy import TextFormatter
 from rich.console import Console
 
 from db_handler import pg_sql
-from utils import exceptions
+from utils import exceptions, exporters
 from utils.models import UserModel
+from utils.id_set import IdSet, PgCopyIdDecoder
+from utils.metrics import metrics
 from db_handler.db_config import DbConnection as DbC
 from utils.logger import log, log_setter
 
@@ -30,12 +36,89 @@ logger = logging.getLogger(__name__)
 # Create rich console instance:
 console = Console()
 
+# Rows the write buffer holds before it is flushed:
+WRITE_BUFFER_ROWS = int(os.environ.get("TWEEASY_WRITE_BUFFER_ROWS", 50_000))
+# Seconds the oldest buffered row may wait before the buffer is flushed:
+WRITE_BUFFER_SECONDS = float(os.environ.get("TWEEASY_WRITE_BUFFER_SECONDS", 30))
+# Flushes a row is tried in before it is dropped (and logged):
+FLUSH_ATTEMPTS = 3
+# Layout of the `users_followers` table. "serial" has a surrogate key and a
+# composite index. "partitioned" is hash-partitioned on user_id, with the
+# natural (user_id, follower_id) primary key; existing tables are moved over
+# at startup.
+JOIN_SCHEMA = os.environ.get("TWEEASY_JOIN_SCHEMA", "serial")
+# Number of hash partitions of the "partitioned" schema:
+JOIN_PARTITIONS = int(os.environ.get("TWEEASY_JOIN_PARTITIONS", 16))
+# With the "partitioned" schema, "deferred" checks the foreign keys once at
+# commit instead of as each row comes in:
+JOIN_FOREIGN_KEYS = os.environ.get("TWEEASY_JOIN_FOREIGN_KEYS", "immediate")
+# Rows of the `users` table kept in memory by `get_known_user`:
+USER_CACHE_SIZE = 1024
+# Rows per batch read by `stream_rows`, and per Parquet row group:
+EXPORT_BATCH_ROWS = 50_000
+
+
+def log_bad_copy(*messages: str) -> None:
+    """Writes the details of a failed COPY to the critical log."""
+    log_file = "./src/data/pg_driver_critical.log"
+    log_setter(__name__, file_name=log_file)
+    pg_logger = logging.getLogger(__name__)
+    for message in messages:
+        pg_logger.critical(message)
+
+
+async def write_copy_rows(copy, rows: Iterable[tuple], table: str) -> None:
+    """Writes <rows> to the text COPY FROM STDIN <copy>, like `write_row`
+    does, and counts the bytes sent in `tweeasy_copy_bytes_total`. Rows are
+    formatted here, in the chunks psycopg would send, since `write_row`
+    doesn't say how many bytes a row made.
+    :param table: table the rows are COPYd into, for the metric's label."""
+    formatter = TextFormatter(copy.formatter.transformer)
+    for row in rows:
+        data = formatter.write_row(row)
+        if data:
+            metrics.incr("tweeasy_copy_bytes_total", len(data), table=table, direction="in")
+            await copy.write(bytes(data))
+    data = formatter.end()
+    if data:
+        metrics.incr("tweeasy_copy_bytes_total", len(data), table=table, direction="in")
+        await copy.write(bytes(data))
+
 
 class UserFollowerDriver:
     """Class for handling data that will have a user-follower relationship. E.g.,
-    performing analysis on a user or group of users based on follower data."""
+    performing analysis on a user or group of users based on follower data.
+
+    Rows from `lookup_users` pages and their joins can be handed to a write
+    buffer (`buffer_lookup_users`, `buffer_joins`) instead of being COPYd a
+    page at a time. The buffer is flushed once it holds `WRITE_BUFFER_ROWS`
+    rows or its oldest row is `WRITE_BUFFER_SECONDS` old, and whenever
+    `flush_buffer` is called.
 
-    def __init__(self):
+    The buffer is shared by every crawl running at once, so rows are loaded
+    through staging tables and rows that are already in the tables (e.g. a
+    follower two crawls both found new) are skipped instead of failing the
+    flush.
+
+    :param upsert_lookups: if True, buffered profiles overwrite those of
+    followers already in the table instead of being skipped, so stale
+    profiles can be refreshed."""
+
+    def __init__(self, upsert_lookups: bool = False):
+        self.upsert_lookups = upsert_lookups
+        # Write buffer. Lookup rows are keyed by id, so an account looked up
+        # for two users at once is only COPYd once:
+        self._lookup_rows: Dict[int, tuple] = {}
+        # (follower_id, user_id) rows:
+        self._join_rows: Set[Tuple[int, int]] = set()
+        self._buffered_since: Union[float, None] = None
+        # Failed flushes each buffered row has been part of:
+        self._flush_failures: Dict[Union[int, Tuple[int, int]], int] = {}
+        self._flush_lock = asyncio.Lock()
+        # LRU cache of `users` rows by lowercase screen name. Read from
+        # executor threads, hence the lock:
+        self._known_users: "OrderedDict[str, List[dict]]" = OrderedDict()
+        self._known_users_lock = threading.Lock()
         # When starting the containers with docker-compose, the database
         # may not be ready to accept connections right away. In that case,
         # we sleep and try again.
@@ -65,6 +148,21 @@ class UserFollowerDriver:
         if not self.check_table_exists("users_followers"):
             self.create_join_table()
             console.log("`users_followers` table not found :exclamation: \nCreating table")
+        else:
+            if not self.check_column_exists("users_followers", "valid_from"):
+                self.add_join_valid_from_column()
+            if JOIN_SCHEMA == "partitioned" and not self.check_table_partitioned("users_followers"):
+                console.log("Moving `users_followers` to the partitioned schema. This may take a while...")
+                self.rebuild_join_table()
+        if not self.check_table_exists("users_followers_history"):
+            self.create_join_history_table()
+            console.log("`users_followers_history` table not found :exclamation: \nCreating table")
+        if not self.check_table_exists("crawl_checkpoints"):
+            self.create_checkpoint_table()
+            console.log("`crawl_checkpoints` table not found :exclamation: \nCreating table")
+        # Tables created by earlier versions may be missing indexes, or
+        # have ones that are no longer wanted:
+        self.migrate_indexes()
 
     @DbC.with_async_connection
     @log
@@ -75,11 +173,17 @@ class UserFollowerDriver:
         table_list: List[str] = [table["tablename"] for table in res_list]
         logger.info(f"Result of fetchall: {res_list}")
         logger.info(f"Table list: {table_list}")
+        # The cached `users` rows are gone with the tables:
+        self.clear_known_users()
         for table in table_list:
             drop_task = asyncio.create_task(self.drop_table(table))
             await drop_task
             if table == "users_followers":
                 self.create_join_table()
+            elif table == "users_followers_history":
+                self.create_join_history_table()
+            elif table == "crawl_checkpoints":
+                self.create_checkpoint_table()
             else:
                 self.create_table(table)
 
@@ -90,20 +194,88 @@ class UserFollowerDriver:
         the account information for users of interest."""
         sql = pg_sql.create_users_or_follower_table(table)
         cursor.execute(sql)
+        self._create_indexes(cursor, table)
         console.log(f"  {table}... :white_check_mark:")
 
+    @staticmethod
+    def _create_indexes(cursor, table: str) -> None:
+        """Creates the secondary indexes of the users or followers table,
+        skipping those that already exist."""
+        if table == "users":
+            cursor.execute(pg_sql.create_screen_name_index())
+        else:
+            cursor.execute(pg_sql.create_collected_index(table))
+
+    @DbC.with_connection
+    @log
+    def migrate_indexes(self, cursor) -> None:
+        """Brings the indexes of the users and followers tables in line with
+        those `create_table` makes: drops indexes that duplicate the primary
+        key and adds any that are missing. Running it again changes nothing."""
+        for table in ("users", "followers"):
+            cursor.execute(pg_sql.get_redundant_indexes(table))
+            for row in cursor.fetchall():
+                cursor.execute(pg_sql.drop_index(row["index_name"]))
+                console.log(f"  Dropped redundant index {row['index_name']} :white_check_mark:")
+            self._create_indexes(cursor, table)
+
     @DbC.with_connection
     @log
     def create_join_table(self, cursor) -> None:
-        """Creates our join table."""
-        sql = pg_sql.create_join_table(
-            "users_followers",
-            ("users", "user_id"),
-            ("followers", "follower_id"),
-        )
-        cursor.execute(sql)
+        """Creates our join table, with the layout set by `JOIN_SCHEMA`."""
+        if JOIN_SCHEMA == "partitioned":
+            cursor.execute(pg_sql.create_partitioned_join_table("users_followers", JOIN_PARTITIONS))
+            cursor.execute(pg_sql.add_join_table_keys("users_followers", JOIN_FOREIGN_KEYS == "deferred"))
+        else:
+            sql = pg_sql.create_join_table(
+                "users_followers",
+                ("users", "user_id"),
+                ("followers", "follower_id"),
+            )
+            cursor.execute(sql)
         console.log(f"  users_followers... :white_check_mark: \n\n")
 
+    @DbC.with_connection
+    @log
+    def rebuild_join_table(self, cursor) -> None:
+        """Moves the rows of an existing `users_followers` table into a new,
+        partitioned one, in a single transaction. The rows are loaded into
+        the bare partitions first and the keys built afterwards, which is far
+        cheaper than maintaining them row by row. Duplicate joins and rows
+        missing an id are dropped on the way."""
+        cursor.execute(pg_sql.rename_table("users_followers", "users_followers_old"))
+        cursor.execute(pg_sql.create_partitioned_join_table("users_followers", JOIN_PARTITIONS))
+        cursor.execute(pg_sql.copy_join_rows("users_followers_old", "users_followers"))
+        console.log(f"  {cursor.rowcount:,} joins copied")
+        # Drop the old table first, so its key names are free:
+        cursor.execute(pg_sql.drop_table("users_followers_old"))
+        cursor.execute(pg_sql.add_join_table_keys("users_followers", JOIN_FOREIGN_KEYS == "deferred"))
+        cursor.execute(pg_sql.analyze_table("users_followers"))
+        console.log(f"  users_followers... :white_check_mark:")
+
+    @DbC.with_connection
+    @log
+    def add_join_valid_from_column(self, cursor) -> None:
+        """Adds the `valid_from` column to a `users_followers` table created
+        by an earlier version."""
+        cursor.execute(pg_sql.add_join_valid_from_column("users_followers"))
+        console.log(f"  Added valid_from column to users_followers :white_check_mark:")
+
+    @DbC.with_connection
+    @log
+    def create_join_history_table(self, cursor) -> None:
+        """Creates the table of ended joins."""
+        cursor.execute(pg_sql.create_join_history_table())
+        console.log(f"  users_followers_history... :white_check_mark:")
+
+    @DbC.with_connection
+    @log
+    def create_checkpoint_table(self, cursor) -> None:
+        """Creates the table of crawl checkpoints."""
+        sql = pg_sql.create_checkpoint_table()
+        cursor.execute(sql)
+        console.log(f"  crawl_checkpoints... :white_check_mark:")
+
     @DbC.with_connection
     @log
     def check_table_exists(self, cursor, table: str) -> bool:
@@ -119,6 +291,26 @@ class UserFollowerDriver:
         else:
             return False
 
+    @DbC.with_connection
+    @log
+    def check_column_exists(self, cursor, table: str, column: str) -> bool:
+        """Checks whether a column exists in a table.
+        :param table: the name of the table to check.
+        :param column: the name of the column.
+        :return: True/False"""
+        cursor.execute(pg_sql.check_column_exists(), (table, column))
+        return cursor.fetchone()["exists"]
+
+    @DbC.with_connection
+    @log
+    def check_table_partitioned(self, cursor, table: str) -> bool:
+        """Checks whether a table is partitioned.
+        :param table: the name of the table to check.
+        :return: True/False"""
+        cursor.execute(pg_sql.check_table_partitioned(table))
+        res = cursor.fetchone()
+        return bool(res and res["partitioned"])
+
     @DbC.with_connection
     @log
     def check_user_exists(self, cursor, username: str, table: str) -> bool:
@@ -126,8 +318,12 @@ class UserFollowerDriver:
         :param username: the username of the person to check.
         :param table: which table to check for the username.
         :return: True/False"""
-        sql = pg_sql.check_user_exists(username, table)
-        cursor.execute(sql)
+        if table != "users" and table != "followers":
+            raise exceptions.TableSpecifierError(
+                table, "The table name must be either `users` or `followers`"
+            )
+        sql = pg_sql.check_user_exists(table)
+        cursor.execute(sql, (username,), prepare=True)
         res = cursor.fetchone()
         if res:
             return True
@@ -141,8 +337,10 @@ class UserFollowerDriver:
         :param table: name of the table we want to drop.
         """
         logger.info(f"dropping {table}")
+        # Cached `users` rows may not be in the table anymore:
+        self.clear_known_users()
         if table == "all":
-            for t in ["followers", "users", "users_followers"]:
+            for t in ["followers", "users", "users_followers", "users_followers_history", "crawl_checkpoints"]:
                 logger.info(f"dropping table {t}")
                 sql = pg_sql.drop_table(t)
                 await cursor.execute(sql)
@@ -173,30 +371,86 @@ class UserFollowerDriver:
             except psycopg.errors.UndefinedTable:
                 console.log(f"{table} table could not be found in the database")
 
-    @DbC.with_async_connection
     @log
-    async def get_all_followers_ids(self, cursor) -> Union[Set[int], None]:
+    async def get_all_followers_ids(self) -> IdSet:
         console.log("Loading pre-existing followers data...")
-        sql = pg_sql.get_all_follower_ids()
-        await cursor.execute(sql)
-        return set(v["follower_id"] for v in await cursor.fetchall())
+        return await self.async_copy_out_ids("followers")
 
-    @DbC.with_async_connection
+    @DbC.with_async_copy
     @log
-    async def get_all_users_followers(self, cursor, user_id: int) -> Union[Set[int], None]:
+    async def get_all_users_followers(self, connection, user_id: int) -> IdSet:
         """Grabs all entries from `users_followers` that have specified `user_id`
-        in `user_id` column of table. Returns just the follower_id data in a set."""
-        sql = pg_sql.get_all_users_followers(user_id)
-        await cursor.execute(sql)
-        return set(v["follower_id"] for v in await cursor.fetchall())
+        in `user_id` column of table. Returns just the follower_id data in an IdSet."""
+        sql = pg_sql.copy_out_users_followers(user_id)
+        decoder = PgCopyIdDecoder()
+        async with connection.cursor().copy(sql) as copy:
+            async for data in copy:
+                decoder.feed(data)
+        follower_ids = decoder.finish()
+        metrics.incr("tweeasy_rows_read_total", len(follower_ids), table="users_followers")
+        return IdSet.from_sorted(follower_ids)
 
     @DbC.with_connection
     @log
     def get_users_row(self, cursor, screen_name):
-        sql = pg_sql.get_users_row(username=screen_name)
-        cursor.execute(sql)
+        sql = pg_sql.get_users_row()
+        cursor.execute(sql, (screen_name,), prepare=True)
         return cursor.fetchall()
 
+    @log
+    def get_known_user(self, screen_name: str) -> Union[List[dict], None]:
+        """Grabs the `users` row of <screen_name>, ignoring case, with an
+        indexed single-row query. Rows found are kept in an in-process LRU
+        cache of `USER_CACHE_SIZE` users.
+        :param screen_name: name following the @ symbol of a Twitter account.
+        :return: the row in a list, as from `get_users_row`, or None if the
+        user isn't in the table."""
+        key = screen_name.lower()
+        with self._known_users_lock:
+            if key in self._known_users:
+                self._known_users.move_to_end(key)
+                return self._known_users[key]
+        rows = self.get_users_row(key)
+        if not rows:
+            return None
+        with self._known_users_lock:
+            self._known_users[key] = rows
+            if len(self._known_users) > USER_CACHE_SIZE:
+                self._known_users.popitem(last=False)
+        return rows
+
+    def clear_known_users(self) -> None:
+        """Empties the cache of `users` rows kept by `get_known_user`."""
+        with self._known_users_lock:
+            self._known_users.clear()
+
+    @DbC.with_async_connection
+    @log
+    async def get_checkpoint(self, cursor, user_id: int) -> Union[dict, None]:
+        """Grabs the checkpoint of an unfinished follower id crawl.
+        :param user_id: Twitter id of the user being crawled.
+        :return: dict with `next_cursor`, `ids_collected` and `updated`,
+        or None if there is no unfinished crawl."""
+        await cursor.execute(pg_sql.get_checkpoint(), (user_id,), prepare=True)
+        return await cursor.fetchone()
+
+    @DbC.with_async_connection
+    @log
+    async def save_checkpoint(self, cursor, user_id: int, next_cursor: int, ids_collected: int) -> None:
+        """Saves the cursor position of a follower id crawl. Should only be
+        called once the ids before <next_cursor> have been handed off.
+        :param user_id: Twitter id of the user being crawled.
+        :param next_cursor: cursor of the next page to fetch.
+        :param ids_collected: number of ids collected so far."""
+        await cursor.execute(pg_sql.upsert_checkpoint(), (user_id, next_cursor, ids_collected), prepare=True)
+
+    @DbC.with_async_connection
+    @log
+    async def clear_checkpoint(self, cursor, user_id: int) -> None:
+        """Removes the checkpoint of a finished follower id crawl.
+        :param user_id: Twitter id of the user that was crawled."""
+        await cursor.execute(pg_sql.delete_checkpoint(), (user_id,), prepare=True)
+
     @DbC.with_async_connection
     @log
     async def insert_user_data(self, cursor, table: str, user_data: UserModel) -> None:
@@ -256,83 +510,328 @@ class UserFollowerDriver:
             )
         )
 
-    @DbC.with_copy
+    @DbC.with_async_copy
+    @log
+    async def async_copy_out_ids(self, connection, table_name: str = "followers") -> IdSet:
+        """COPYs the ids of <table_name> out in binary format, decoded
+        straight into the buffer of an IdSet."""
+        sql = pg_sql.copy_out_ids(table_name)
+        decoder = PgCopyIdDecoder()
+        async with connection.cursor().copy(sql) as copy:
+            async for data in copy:
+                decoder.feed(data)
+        follower_ids = decoder.finish()
+        metrics.incr("tweeasy_rows_read_total", len(follower_ids), table=table_name)
+        return IdSet.from_sorted(follower_ids)
+
+    @staticmethod
+    async def _async_stage_ids(cursor, ids: Iterable[int]) -> None:
+        """COPYs ids into the connection's `staged_ids` temp table. Must be
+        called inside the transaction that reads the staged rows back."""
+        await cursor.execute(pg_sql.create_staged_ids_table())
+        async with cursor.copy(pg_sql.copy_in_staged_ids()) as copy:
+            await write_copy_rows(copy, ((_id,) for _id in ids), "staged_ids")
+
+    @DbC.with_async_copy
     @log
-    def copy_out_user_sn(self, connection) -> set:
-        sql = pg_sql.copy_out_user_sn()
-        user_sns = set()
-        with connection.cursor().copy(sql) as copy:
-            for row in copy.rows():
-                user_sns.add(row[0].lower())
-        return user_sns
+    async def async_filter_unique_ids(
+            self, connection, user_id: int, ids: Iterable[int]
+    ) -> Tuple[Set[int], Set[int]]:
+        """Filters a batch of follower ids on the server, so existing ids
+        never have to be loaded into memory.
+        :param user_id: the user the follower ids belong to.
+        :param ids: batch of follower ids.
+        :return: ids not in `followers`, ids not joined to <user_id>."""
+        # The connection is in autocommit mode, but the staged rows only
+        # live until the end of the transaction:
+        async with connection.transaction():
+            async with connection.cursor() as cursor:
+                await self._async_stage_ids(cursor, ids)
+                await cursor.execute(pg_sql.select_new_follower_ids(), prepare=True)
+                unique_ids = set(row[0] for row in await cursor.fetchall())
+                await cursor.execute(pg_sql.select_new_join_ids(), (user_id,), prepare=True)
+                unique_joins = set(row[0] for row in await cursor.fetchall())
+        return unique_ids, unique_joins
 
-    @DbC.with_copy
+    @DbC.with_async_copy
     @log
-    def copy_out_ids(self, connection, table_name: str = "followers") -> Set[int]:
-        follower_ids: set = set()
-        sql = pg_sql.copy_out_ids(table_name)
-        with connection.cursor().copy(sql) as copy:
-            while data := copy.read():
-                follower_ids.add(int(data))
-        return follower_ids
-
-    # TODO: Fix indirect approach (return)!
-    @DbC.with_copy
-    @log
-    def copy_out_all(self, connection, table_name: str = ""):
-        out_data = bytearray()
-        sql = pg_sql.copy_out_all(table_name)
-        with open(f"./src/data/copy_out_all_{table_name}.out", "wb") as out_file:
+    async def async_filter_stale_ids(
+            self, connection, ids: Iterable[int], stale_after_days: float
+    ) -> Set[int]:
+        """Filters a batch of follower ids down to those already in `followers`
+        whose profile was never looked up, or not for <stale_after_days>.
+        :param ids: batch of follower ids.
+        :param stale_after_days: age at which a profile is stale.
+        :return: ids of the stale profiles."""
+        async with connection.transaction():
+            async with connection.cursor() as cursor:
+                await self._async_stage_ids(cursor, ids)
+                await cursor.execute(pg_sql.select_stale_follower_ids(), (stale_after_days,), prepare=True)
+                return set(row[0] for row in await cursor.fetchall())
+
+    @DbC.with_async_copy
+    @log
+    async def async_close_joins(self, connection, user_id: int, ids: Iterable[int]) -> Set[int]:
+        """Ends the joins of <ids> to <user_id>, recording that they
+        unfollowed: the joins are moved to `users_followers_history`.
+        :param user_id: the user that was unfollowed.
+        :param ids: ids of the followers who unfollowed.
+        :return: ids whose join was ended."""
+        async with connection.transaction():
+            async with connection.cursor() as cursor:
+                await self._async_stage_ids(cursor, ids)
+                await cursor.execute(pg_sql.close_staged_joins(), (user_id,), prepare=True)
+                closed = set(row[0] for row in await cursor.fetchall())
+        metrics.incr("tweeasy_rows_written_total", len(closed), table="users_followers_history")
+        return closed
+
+    @DbC.with_async_copy
+    @log
+    async def async_copy_in_dedup_ids(
+            self, connection, user_id: int, ids: Iterable[int]
+    ) -> Tuple[Set[int], Set[int]]:
+        """Stages a batch of follower ids and inserts the new ones into
+        `followers` and `users_followers` on the server.
+        :param user_id: the user the follower ids belong to.
+        :param ids: batch of follower ids.
+        :return: ids added to `followers`, ids newly joined to <user_id>."""
+        async with connection.transaction():
+            async with connection.cursor() as cursor:
+                await self._async_stage_ids(cursor, ids)
+                await cursor.execute(pg_sql.insert_staged_ids(), prepare=True)
+                unique_ids = set(row[0] for row in await cursor.fetchall())
+                await cursor.execute(pg_sql.insert_staged_joins(), (user_id, user_id), prepare=True)
+                unique_joins = set(row[0] for row in await cursor.fetchall())
+        metrics.incr("tweeasy_rows_written_total", len(unique_ids), table="followers")
+        metrics.incr("tweeasy_rows_written_total", len(unique_joins), table="users_followers")
+        return unique_ids, unique_joins
+
+    def stream_copy_out(self, table_name: str, user_id: Union[int, None] = None) -> Iterator[bytes]:
+        """Yields the rows of <table_name> (see `pg_sql.select_for_export` for
+        <user_id>) as COPY text, tab separated with one row per line, in
+        chunks as they arrive. Holds a pooled connection until the generator
+        is exhausted or closed."""
+        sql = pg_sql.copy_out_query(pg_sql.select_for_export(table_name, user_id))
+        with DbC.get_pool().connection() as connection:
             with connection.cursor().copy(sql) as copy:
                 for data in copy:
+                    metrics.incr("tweeasy_copy_bytes_total", len(data), table=table_name, direction="out")
+                    yield bytes(data)
+
+    def stream_rows(self, table_name: str, user_id: Union[int, None] = None) -> Iterator[List[tuple]]:
+        """Yields the rows of <table_name> (see `pg_sql.select_for_export` for
+        <user_id>) in batches of `EXPORT_BATCH_ROWS`, read through a
+        server-side cursor. Holds a pooled connection until the generator is
+        exhausted or closed."""
+        with DbC.get_pool().connection() as connection:
+            with connection.cursor(name="tweeasy_export") as cursor:
+                cursor.execute(pg_sql.select_for_export(table_name, user_id))
+                while True:
+                    rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                    if not rows:
+                        return
+                    metrics.incr("tweeasy_rows_read_total", len(rows), table=table_name)
+                    yield rows
+
+    @DbC.with_connection
+    @log
+    def export_columns(self, cursor, table_name: str) -> List[Tuple[str, int]]:
+        """Name and type oid of each column `stream_rows` yields for <table_name>."""
+        cursor.execute(pg_sql.select_for_export(table_name) + " LIMIT 0")
+        return [(column.name, column.type_code) for column in cursor.description]
+
+    @log
+    def export_table(
+            self,
+            table_name: str,
+            file_format: str = "tsv.gz",
+            user_id: Union[int, None] = None
+    ) -> str:
+        """Streams <table_name> to `./src/data/export_<table_name>.<file_format>`
+        (with `_<user_id>` before the extension if given), in bounded memory.
+        :param table_name: users, followers, users_followers,
+        users_followers_history or crawl_checkpoints.
+        :param file_format: one of `exporters.EXPORT_FORMATS`.
+        :param user_id: if given, only rows related to this user are exported.
+        :return: path of the file written."""
+        if table_name not in (
+                "users", "followers", "users_followers", "users_followers_history", "crawl_checkpoints"):
+            raise exceptions.TableSpecifierError(table_name, "Unknown table")
+        if file_format not in exporters.EXPORT_FORMATS:
+            raise ValueError(f"file_format must be one of {exporters.EXPORT_FORMATS}")
+        suffix = f"_{user_id}" if user_id is not None else ""
+        path = f"./src/data/export_{table_name}{suffix}.{file_format}"
+        if file_format == "parquet":
+            with exporters.ParquetRowWriter(path, self.export_columns(table_name)) as writer:
+                for rows in self.stream_rows(table_name, user_id):
+                    writer.write_rows(rows)
+        else:
+            compression = file_format.split(".")[1] if "." in file_format else None
+            with exporters.open_tsv(path, compression) as out_file:
+                for data in self.stream_copy_out(table_name, user_id):
                     out_file.write(data)
-                    out_data += bytearray(data)
-        return out_data
+        return path
 
-    @DbC.with_copy
+    @DbC.with_async_copy
     @log
-    def copy_in_ids(self, connection, file):
-        sql = pg_sql.copy_in_ids()
-        with connection.cursor() as cursor:
-            with open(file, "rb") as in_file:
-                # Copy in to follower's table:
-                with cursor.copy(sql) as copy:
-                    while data := in_file.read():
-                        copy.write(data)
+    async def async_copy_in_ids(self, connection, ids: Iterable[int]):
+        """COPYs follower ids into a staging table and inserts them into the
+        `followers` table from there, skipping those already in it. Crawls
+        running at once may both find the same follower new."""
+        async with connection.transaction():
+            async with connection.cursor() as cursor:
+                await self._async_stage_ids(cursor, ids)
+                await cursor.execute(pg_sql.insert_staged_ids(), prepare=True)
+                inserted = cursor.rowcount
+        metrics.incr("tweeasy_rows_written_total", inserted, table="followers")
 
-    @DbC.with_copy
+    @DbC.with_async_copy
     @log
-    def copy_in_join(self, connection, join_data: str):
+    async def async_copy_in_join(self, connection, user_id: int, follower_ids: Iterable[int]):
+        """COPYs follower ids into a staging table and joins them to <user_id>
+        in the `users_followers` table from there, skipping joins that already
+        exist (e.g. the same user crawled twice, or a restart after a partial
+        flush), which the partitioned layout's primary key would reject."""
         try:
-            sql = pg_sql.copy_in_join_table()
-            with connection.cursor() as cursor:
-                with cursor.copy(sql) as copy:
-                    copy.write(join_data)
+            async with connection.transaction():
+                async with connection.cursor() as cursor:
+                    await self._async_stage_ids(cursor, follower_ids)
+                    await cursor.execute(pg_sql.insert_staged_joins(), (user_id, user_id), prepare=True)
+                    inserted = cursor.rowcount
+            metrics.incr("tweeasy_rows_written_total", inserted, table="users_followers")
         except psycopg.errors.BadCopyFileFormat:
-            # Set up log:
-            log_file = "./src/data/pg_driver_critical.log"
-            log_setter(__name__, file_name=log_file)
-            pg_logger = logging.getLogger(__name__)
-            pg_logger.critical("BadCopyFileFormat error.\n")
-            pg_logger.critical(f"join_data: {join_data}\n")
+            log_bad_copy(
+                "BadCopyFileFormat error.\n",
+                f"user_id: {user_id}, follower_ids: {list(follower_ids)}\n")
             raise
 
-    @DbC.with_copy
+    @DbC.with_async_copy
     @log
-    def copy_in_lookup_users(self, connection, table_name: str, user_data: str):
+    async def async_copy_in_lookup_users(self, connection, table_name: str, rows: List[tuple]):
+        """COPYs user rows, as built by `formatters.user_rows`, into <table_name>."""
         try:
             sql = pg_sql.copy_in_lookup_users(table_name)
-            with connection.cursor() as cursor:
-                with cursor.copy(sql) as copy:
-                    copy.write(user_data[:-3])
+            async with connection.cursor() as cursor:
+                async with cursor.copy(sql) as copy:
+                    await write_copy_rows(copy, rows, table_name)
+            metrics.incr("tweeasy_rows_written_total", len(rows), table=table_name)
+        except psycopg.errors.BadCopyFileFormat:
+            id_list = [row[0] for row in rows]
+            log_bad_copy(f"BadCopyFileFormat error. id_list: {id_list}\n", f"rows: {rows}\n")
+            raise
+
+    @property
+    def buffered_rows(self) -> int:
+        """Number of rows waiting in the write buffer."""
+        return len(self._lookup_rows) + len(self._join_rows)
+
+    async def buffer_lookup_users(self, rows: List[tuple]) -> None:
+        """Adds user rows, as built by `formatters.user_rows`, to the write
+        buffer for the `followers` table."""
+        for row in rows:
+            self._lookup_rows[row[0]] = row
+        await self._after_buffering()
+
+    async def buffer_joins(self, user_id: int, follower_ids: Iterable[int]) -> None:
+        """Adds (follower_id, <user_id>) rows to the write buffer for the
+        `users_followers` table. The followers must either be in the table
+        already or have been buffered with `buffer_lookup_users`."""
+        self._join_rows.update((_id, user_id) for _id in follower_ids)
+        await self._after_buffering()
+
+    async def _after_buffering(self) -> None:
+        if self._buffered_since is None:
+            self._buffered_since = time.monotonic()
+        if (self.buffered_rows >= WRITE_BUFFER_ROWS
+                or time.monotonic() - self._buffered_since >= WRITE_BUFFER_SECONDS):
+            await self.flush_buffer()
+
+    @log
+    async def flush_buffer(self) -> None:
+        """COPYs everything in the write buffer into the database, in one
+        transaction. Flushes run one at a time; rows buffered while a flush
+        is running wait for the next one. If the flush fails, its rows are
+        put back in the buffer for the next one to retry, unless they have
+        failed `FLUSH_ATTEMPTS` times already. Those are written to the
+        critical log and dropped, so rows that can never be written (e.g. a
+        join to a follower that isn't in the table) don't fail every later
+        flush."""
+        async with self._flush_lock:
+            if not self.buffered_rows:
+                return
+            lookup_rows = list(self._lookup_rows.values())
+            join_rows = list(self._join_rows)
+            self._lookup_rows, self._join_rows = {}, set()
+            self._buffered_since = None
+            try:
+                await self._async_copy_in_buffer(lookup_rows, join_rows)
+            except BaseException as e:
+                # A cancelled flush didn't fail, so it doesn't count as an attempt:
+                failed = not isinstance(e, asyncio.CancelledError)
+                dropped_lookups, dropped_joins = [], []
+                # Profiles buffered since are newer, so they take precedence:
+                for row in lookup_rows:
+                    if failed and self._count_failure(row[0]):
+                        dropped_lookups.append(row)
+                    else:
+                        self._lookup_rows.setdefault(row[0], row)
+                for row in join_rows:
+                    if failed and self._count_failure(row):
+                        dropped_joins.append(row)
+                    else:
+                        self._join_rows.add(row)
+                if dropped_lookups or dropped_joins:
+                    log_bad_copy(
+                        f"Dropped after {FLUSH_ATTEMPTS} failed flushes ({e!r}). "
+                        f"lookup rows: {dropped_lookups}\n", f"join_rows: {dropped_joins}\n")
+                if self.buffered_rows and self._buffered_since is None:
+                    self._buffered_since = time.monotonic()
+                raise
+            for row in lookup_rows:
+                self._flush_failures.pop(row[0], None)
+            for row in join_rows:
+                self._flush_failures.pop(row, None)
+            logger.info(f"flushed {len(lookup_rows):,} lookup rows and {len(join_rows):,} join rows")
+
+    def _count_failure(self, key: Union[int, Tuple[int, int]]) -> bool:
+        """Counts a failed flush of the buffered row with <key> (a follower
+        id or a join). True if the row is out of attempts, which resets
+        its count."""
+        failures = self._flush_failures.get(key, 0) + 1
+        if failures >= FLUSH_ATTEMPTS:
+            self._flush_failures.pop(key, None)
+            return True
+        self._flush_failures[key] = failures
+        return False
+
+    @DbC.with_async_copy
+    @log
+    async def _async_copy_in_buffer(
+            self, connection, lookup_rows: List[tuple], join_rows: List[Tuple[int, int]]
+    ) -> None:
+        """COPYs the contents of the write buffer into staging tables and
+        inserts them from there. Followers go in first, so the joins' foreign
+        keys are satisfied. Followers already in the table are skipped, or
+        upserted with `upsert_lookups`; joins that already exist are skipped."""
+        users_written, joins_written = 0, 0
+        try:
+            async with connection.transaction():
+                async with connection.cursor() as cursor:
+                    if lookup_rows:
+                        await cursor.execute(pg_sql.create_staged_users_table())
+                        async with cursor.copy(pg_sql.copy_in_lookup_users("staged_users")) as copy:
+                            await write_copy_rows(copy, lookup_rows, "staged_users")
+                        await cursor.execute(pg_sql.insert_staged_users(self.upsert_lookups), prepare=True)
+                        users_written = cursor.rowcount
+                    if join_rows:
+                        await cursor.execute(pg_sql.create_staged_joins_table())
+                        async with cursor.copy(pg_sql.copy_in_staged_joins()) as copy:
+                            await write_copy_rows(copy, join_rows, "staged_joins")
+                        await cursor.execute(pg_sql.insert_staged_join_rows(), prepare=True)
+                        joins_written = cursor.rowcount
+            metrics.incr("tweeasy_rows_written_total", users_written, table="followers")
+            metrics.incr("tweeasy_rows_written_total", joins_written, table="users_followers")
         except psycopg.errors.BadCopyFileFormat:
-            data_list = user_data.split("\n")
-            # Grab first element of list, which is user's Twitter id:
-            id_list = [user.split("\t")[0] for user in data_list]
-            # Set up log:
-            log_file = "./src/data/pg_driver_critical.log"
-            log_setter(__name__, file_name=log_file)
-            pg_logger = logging.getLogger(__name__)
-            pg_logger.critical(f"BadCopyFileFormat error. id_list: {id_list}\n")
-            pg_logger.critical(f"data_list: {data_list}\n")
+            id_list = [row[0] for row in lookup_rows]
+            log_bad_copy(f"BadCopyFileFormat error. id_list: {id_list}\n", f"join_rows: {join_rows}\n")
             raise
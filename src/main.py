@@ -1,12 +1,17 @@
+import os
 import sys
 import time
-from typing import List, Tuple, Set, Union
+from typing import Coroutine, List, Tuple, Set, Union
 from pathlib import Path
 import asyncio
 import platform
 import datetime
 import logging
+from array import array
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
+import psycopg
 import tweepy
 from tweepy.models import User
 from rich import print
@@ -17,10 +22,17 @@ from rich.markdown import Markdown
 from rich.panel import Panel
 from rich.live import Live
 
-from utils.api_config import with_api1_connection 
-from utils.formatters import user_bytearray, format_time
+from utils.api_config import with_api1_connection, with_api2_connection, api1_clients, api2_clients, rate_limits_for, close_clients
+from utils.exceptions import TableSpecifierError
+from utils.exporters import EXPORT_FORMATS
+from utils.formatters import API2_USER_FIELDS, user_rows, user_row_v2, format_time
+from utils.id_set import IdSet
 from utils.logger import log, logger, log_setter
+from utils.lookup_cache import LookupCache, LOOKUP_CACHE_FILE, LOOKUP_CACHE_TTL
+from utils.metrics import metrics
+from utils.rate_limiter import TokenBucket
 from db_handler.tweeasy_handler import UserFollowerDriver
+from db_handler.db_config import DbConnection as DbC
 
 # TODO: Implement API handler class in its own module
 
@@ -29,6 +41,33 @@ logger.info(f"\n\n\t\t\t[{datetime.datetime.now()}]")
 log_setter(__name__, format="\t%(lineno)d - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Where follower ids are deduplicated. "server" COPYs each batch into a staging
+# table and filters it with an anti-join, so memory stays bounded. "client"
+# loads all existing ids into memory before the query starts.
+DEDUP_MODE = os.environ.get("TWEEASY_DEDUP_MODE", "server")
+# When running `lookup_users`, followers already in the table whose profile is
+# older than this many days (or was never looked up) are looked up again and
+# their rows updated. 0 turns refreshing off.
+REFRESH_DAYS = float(os.environ.get("TWEEASY_REFRESH_DAYS", 0))
+# API used to collect full follower data. "v1" pages through follower ids and
+# looks them up 100 at a time; "v2" gets 1,000 full profiles per request from
+# `get_users_followers`.
+CRAWL_ENGINE = os.environ.get("TWEEASY_CRAWL_ENGINE", "v1")
+# Diff each crawl against the followers recorded by the last one: only new
+# followers are processed, unfollows are recorded, and paging stops early once
+# nothing can have changed further down the list.
+INCREMENTAL = os.environ.get("TWEEASY_INCREMENTAL", "0") not in ("", "0")
+# Run of consecutive already-known ids after which incremental paging may stop:
+INCREMENTAL_STOP_IDS = int(os.environ.get("TWEEASY_INCREMENTAL_STOP_IDS", 5_000))
+# Number of `lookup_users` queries (100 ids each) kept in flight at once:
+LOOKUP_CONCURRENCY = int(os.environ.get("TWEEASY_LOOKUP_CONCURRENCY", 4))
+# Number of users crawled at once when iterating over a list of users:
+CRAWL_CONCURRENCY = int(os.environ.get("TWEEASY_CRAWL_CONCURRENCY", 4))
+# Pages of follower ids (5,000 each) that can wait between fetcher and writer:
+PIPELINE_QUEUE_PAGES = int(os.environ.get("TWEEASY_QUEUE_PAGES", 4))
+# Most pages the writer filters and hands off in one go:
+WRITE_BATCH_PAGES = 10
+
 MENU = """
 # Options 
 1. Get user data
@@ -38,6 +77,7 @@ MENU = """
 5. Get row count for table(s)
 6. Drop a table
 7. Exit
+8. Export a table
 """
 
 # Initialize rich traceback:
@@ -45,7 +85,15 @@ install()
 # Create rich console instance for logging:
 console = Console()
 # Create db handler instance:
-sf_db = UserFollowerDriver()
+sf_db = UserFollowerDriver(upsert_lookups=REFRESH_DAYS > 0)
+# Threads for the blocking tweepy calls made by coroutines. Database calls
+# made by coroutines go through the async pool instead:
+executor = ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY + CRAWL_CONCURRENCY)
+# Profiles already fetched by `lookup_users`, reused instead of spending quota.
+# When refreshing, a cached profile mustn't be older than a stale one:
+lookup_cache = LookupCache(
+    ttl=min(LOOKUP_CACHE_TTL, REFRESH_DAYS * 24) if REFRESH_DAYS > 0 else LOOKUP_CACHE_TTL
+) if LOOKUP_CACHE_FILE else None
 # Create progress bars:
 id_progress = Progress(
     TextColumn("follower id query"),
@@ -90,19 +138,21 @@ def get_username_list() -> List[str]:
 
 
 @log
-def process_ids(user_id: int, ids: Set[int], just_ids: bool) -> None:
+async def process_ids(user_id: int, ids: Union[Set[int], IdSet], just_ids: bool) -> None:
     # If lookup_users query isn't being run, then
     # it is safe to copy follower ids into followers table:
     if just_ids:
-        sf_db.copy_in_ids("\n".join(str(_id) for _id in ids))
-    join_data = f"\t{user_id}\n".join(str(_id) for _id in ids) + f"\t{user_id}"
-    sf_db.copy_in_join(join_data)
+        await sf_db.async_copy_in_ids(ids)
+    await sf_db.async_copy_in_join(user_id, ids)
 
 
 @log
-def process_lookup_users(users_list: List[User], ids_exist: bool = False) -> None:
-    users_bytearr: bytearray = user_bytearray(users_list, ids_exist)
-    sf_db.copy_in_lookup_users("followers", users_bytearr.decode())
+async def process_lookup_users(users_list: List[User]) -> List[tuple]:
+    """Buffers the rows of <users_list> and returns them. Users that
+    `user_rows` can't adapt have no row."""
+    rows = user_rows(users_list)
+    await sf_db.buffer_lookup_users(rows)
+    return rows
 
 
 @log
@@ -122,47 +172,65 @@ async def sleep_track(reset_time) -> None:
     sleep_progress.stop_task(sleep_task)
 
 
+# Rate limit window of the v2 followers endpoint, per account:
+API2_FOLLOWERS_ENDPOINT = "/2/users/:id/followers"
+API2_FOLLOWERS_LIMIT = 15
+# Endpoint names, as used by `rate_limit_status`, for each query:
+RATE_LIMIT_ENDPOINTS = {
+    "ids": ("followers", "/followers/ids"),
+    "lookup": ("users", "/users/lookup"),
+}
+
+
 @with_api1_connection
 @log
 def get_rate_limit(api, query: str = "ids") -> Tuple[int, int]:
     """Grabs the statuses for our Twitter API account, related to
-    type of query. If relevant, formats remaining queries (rate_limit)
-    according to Tweepy's pagination capability.
+    type of query.
+
+    The window is read from the account's `rate_limits_for(api)` tracker,
+    which is kept up to date by the
+    headers of every response. `api.rate_limit_status()` (itself rate
+    limited) is only called when the window is unknown or has reset.
 
     Args:
-        api (tweepy.api.API): supplied by decorator.
+        api (tweepy.api.API): supplied by decorator, or by the caller with
+        the `api` keyword argument to check a specific account.
         query (str): query the rate limit pertains to. E.g., `ids` for 
         'get_follower_ids' query. `lookup` for 'lookup_users' query.
         Defaults to `ids`.
     Returns:
         Tuple:
-            rate_limit (int): how many more queries we can make. `ids` assumes
-            use of tweepy.Cursor with count parameter set to 5,000. We
-            subtract one to make sure we don't trigger tweepy.api.API's own
-            sleeper. `lookup` assumes grouping of 100 accounts.
+            rate_limit (int): how many more requests we can make. For `ids`
+            each request is a page of up to 5,000 ids; for `lookup` each
+            request can look up 100 accounts.
             reset_time (int): interval between current time and time at
             which our rate limit will reset.
     """
-    status = api.rate_limit_status()
-    if query == "ids":
-        id_rate_status = status["resources"]["followers"]["/followers/ids"]
-        rate_limit = id_rate_status["remaining"] * 5_000 - 1 if id_rate_status["remaining"] else 0
-        reset_time = id_rate_status["reset"] - int(time.time())
-        return rate_limit, reset_time
-    elif query == "lookup":
-        lookup_rate_status = status["resources"]["users"]["/users/lookup"]
-        logger.debug(f"lookup rate_status = {lookup_rate_status}")
-        rate_limit = lookup_rate_status["remaining"] * 100 - 1 if lookup_rate_status["remaining"] else 0
-        reset_time = lookup_rate_status["reset"] - int(time.time())
-        return rate_limit, reset_time
+    family, endpoint = RATE_LIMIT_ENDPOINTS[query]
+    rate_limits = rate_limits_for(api)
+    window = rate_limits.get(endpoint)
+    if window is None:
+        logger.debug(f"rate limit for {endpoint} unknown, calling `rate_limit_status`")
+        status = api.rate_limit_status(resources=family)
+        rate_limits.update_from_status(status)
+        window = rate_limits.get(endpoint)
+        if window is None:
+            # Reset time already passed, so the window is full again:
+            window_status = status["resources"][family][endpoint]
+            window = window_status["limit"], int(time.time())
+    remaining, reset = window
+    logger.debug(f"{endpoint} remaining = {remaining}, reset = {reset}")
+    reset_time = reset - int(time.time())
+    return remaining, reset_time
 
 
 @with_api1_connection
 @log
 def api1_get_user(api, username: str) -> Tuple[Union[User, List[dict]], bool]:
-    """Loads all pre-existing users from users table. If <username> not already
-    in table, calls api for user data. If <username> already in table, just passes
-    user data loaded from table back to caller.
+    """Looks <username> up in the users table (see `get_known_user`). If
+    <username> not already in table, calls api for user data. If <username>
+    already in table, just passes user data loaded from table back to caller.
 
     Args:
         api (tweepy.api.API): supplied by decorator.
@@ -177,19 +245,56 @@ def api1_get_user(api, username: str) -> Tuple[Union[User, List[dict]], bool]:
                     `get_user` method, List[dict] has been formatted from database.
             Bool: Whether the user data already existed in the database.
     """
-    user_sns: set = sf_db.copy_out_user_sn()
-    if username not in user_sns:
+    user_row = sf_db.get_known_user(username)
+    if user_row is None:
         live.console.print(f"Executing `[yellow]get_user[/]` query for [green]{username}[/]...")
         return api.get_user(screen_name=username), False
     else:
         live.console.print(f"[greeen]{username}[/] already in `users` table")
-        return sf_db.get_users_row(username), True
+        return user_row, True
+
+
+@log
+async def pick_api(query: str = "ids") -> Tuple[tweepy.API, int, int]:
+    """Picks the account in the credentials pool with the most `query`
+    quota left. If every account is exhausted, sleeps until the first
+    window resets.
+
+    Args:
+        query (str): `ids` or `lookup`, as for `get_rate_limit`.
+    Returns:
+        Tuple: the account's client, and its `get_rate_limit` result.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        # `get_rate_limit` may have to call the API, so check on the executor:
+        limits = await asyncio.gather(*(
+            loop.run_in_executor(executor, partial(get_rate_limit, query=query, api=api))
+            for api in api1_clients()))
+        windows = list(zip(limits, api1_clients()))
+        (rate_limit, reset_time), api = max(windows, key=lambda window: window[0][0])
+        if rate_limit:
+            return api, rate_limit, reset_time
+        await sleep_track(max(min(window[0][1] for window in windows), 1))
+
+
+@log
+def api1_get_follower_ids_page(api: tweepy.API, cursor: int, **user) -> Tuple[List[int], int]:
+    """Fetches one page of up to 5,000 follower ids.
+
+    Args:
+        api (tweepy.API): client of the account the request is charged to.
+        cursor (int): position to fetch from; -1 for the first page.
+        **user: `screen_name` or `user_id` of the user whose followers are fetched.
+    Returns:
+        Tuple: the ids, and the cursor of the next page (0 after the last one).
+    """
+    ids, (_, next_cursor) = api.get_follower_ids(count=5_000, cursor=cursor, **user)
+    return ids, next_cursor
 
 
-@with_api1_connection
 @log
 async def api1_get_follower_ids(
-        api,
         user_data: Union[User, List[dict]],
         just_ids: bool = True
 ) -> None:
@@ -201,15 +306,24 @@ async def api1_get_follower_ids(
     Unique ids will then either be passed to the `process_ids` function (if
     `just_ids` == True) or the `lookup_users` function (if `just_ids == False).
 
-    We track the rate limit specific to this query throughout the process. If we
-    are about to hit the rate limit the collection process will pause and all
-    collected ids will be filtered and either processed or passed to `lookup_users`
-    at this time. If the rate limit has not yet reset before these tasks are
-    finished then we sleep.
+    Ids are handled a whole page (up to 5,000 ids) at a time, in a producer/
+    consumer pipeline: one task fetches pages and pushes them onto a bounded
+    queue, while a writer task takes whatever pages are waiting, filters them
+    and hands them off as one batch. So the API and the database are busy at
+    the same time, and the queue size caps how far fetching can run ahead.
 
-    Args:
-        api (tweepy.api.API): supplied by decorator
+    Every page is charged to `ids_bucket`, which is shared by all users being
+    crawled, so concurrent crawls never overspend a window. Whenever an
+    account runs out of quota, paging continues from the same cursor position
+    with whichever account in the credentials pool has quota left (see
+    `pick_api`). Pages are fetched on the executor, so while this user waits
+    on the network or the rate limit other users' work carries on.
+
+    After each batch has been handed off, the cursor position is saved to the
+    `crawl_checkpoints` table. If the crawl is interrupted, the next crawl of
+    the same user resumes from that position instead of the first page.
 
+    Args:
         user_data (Union): user_data object will either be List[dict], if user
         already exists in users table, or tweepy.models.User, if user does not
         already exist in users table.
@@ -217,8 +331,7 @@ async def api1_get_follower_ids(
         just_ids (bool): indicates whether we just want to perform this query,
         or if we also want to perform the `lookup_users` query on the follower ids
         we collect. If just_ids == False, then we will hand off the follower ids
-        to the `lookup_users` query either once we have collected all the ids or
-        once we have reached the query rate limit and are waiting for it to reset.
+        of each page to the `lookup_users` query.
     """
 
     # If `username` passed at earlier stage already exists in the database, then
@@ -232,208 +345,664 @@ async def api1_get_follower_ids(
         username = user_data.screen_name
         user_id = user_data.id
         followers_count = user_data.followers_count
-    # Set of pre-existing id data in `users_followers` table for this user.
-    # We initialize coroutine task since this table can be significantly larger
-    # than `followers` table:
-    load_join_task = asyncio.create_task(sf_db.get_all_users_followers(user_id))
-    join_table_data: set = await load_join_task
-    # Set of pre-existing follower_id data in `followers` table:
-    follower_table_data: set = sf_db.copy_out_ids(table_name="followers")
+    join_table_data, follower_table_data = None, None
+    if DEDUP_MODE == "client":
+        # Set of pre-existing id data in `users_followers` table for this user.
+        # We initialize coroutine task since this table can be significantly larger
+        # than `followers` table:
+        load_join_task = asyncio.create_task(sf_db.get_all_users_followers(user_id))
+        # Set of pre-existing follower_id data in `followers` table, loaded
+        # at the same time on another pooled connection:
+        follower_table_data = await sf_db.async_copy_out_ids(table_name="followers")
+        join_table_data = await load_join_task
+
+    # Resume from the checkpoint of an unfinished crawl, if there is one:
+    checkpoint = await sf_db.get_checkpoint(user_id)
+    start_cursor = checkpoint["next_cursor"] if checkpoint else -1
+    ids_collected = checkpoint["ids_collected"] if checkpoint else 0
 
     # Set up rich progress bar task for query:
+    id_task: TaskID = id_progress.add_task("follower ids", total=followers_count, completed=ids_collected)
+    # Count of new unique ids found during session:
+    total_unique = 0
+
+    live.console.print(f"[green]{username}[/]: {followers_count:,} followers")
+    if checkpoint:
+        live.console.print(
+            f"Resuming crawl of [green]{username}[/] after {ids_collected:,} ids "
+            f"(checkpoint from {checkpoint['updated']:%Y-%m-%d %H:%M})")
+    live.console.print("Executing `[yellow]get_follower_ids[/]` query...")
+    loop = asyncio.get_running_loop()
+    # Pages fetched but not yet written; bounded so fetching can't run far
+    # ahead of the database:
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_PAGES)
+
+    async def fetch_pages() -> None:
+        """Producer: pushes (page, next_cursor, ids_collected) onto the queue
+        until the cursor is exhausted, then the end-of-pages marker."""
+        nonlocal ids_collected
+        next_cursor = start_cursor
+        cancelled = False
+        try:
+            # Iterate through pages of follower ids until the cursor is exhausted:
+            while next_cursor != 0:
+                # Take a request from the shared budget (sleeps if all accounts are
+                # exhausted) and fetch the next page with the account it belongs to,
+                # from the cursor position reached so far:
+                async with ids_bucket.request() as api:
+                    # Fetch on the executor, so other users' work goes on meanwhile:
+                    page, next_cursor = await loop.run_in_executor(executor, partial(
+                        api1_get_follower_ids_page, api, next_cursor, screen_name=username))
+                if not page:
+                    break
+                ids_collected += len(page)
+                # Update progress bar:
+                id_progress.update(id_task, advance=len(page))
+                # Waits here while the queue is full:
+                await page_queue.put((page, next_cursor, ids_collected))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Let the writer drain what was fetched, even if fetching failed.
+            # If the writer has stopped (hence the cancel), nobody would take
+            # the marker off a full queue:
+            if not cancelled:
+                await page_queue.put(None)
+
+    async def write_pages() -> None:
+        """Consumer: batches the queued pages (up to `WRITE_BATCH_PAGES`) into
+        a single filtering and hand-off step, then checkpoints the cursor of
+        the last page in the batch."""
+        nonlocal total_unique
+        finished = False
+        while not finished:
+            item = await page_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Add whatever else is already waiting to the batch:
+            while len(batch) < WRITE_BATCH_PAGES and not page_queue.empty():
+                item = page_queue.get_nowait()
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+            ids = [_id for page, _, _ in batch for _id in page]
+            unique_ids = await flush_ids(user_id, ids, just_ids, follower_table_data, join_table_data)
+            total_unique += len(unique_ids)
+            # Everything before the cursor is in the database now, so a
+            # restart can pick up from here:
+            _, next_cursor, collected = batch[-1]
+            # Lookups and joins may still sit in the write buffer, and the
+            # checkpoint mustn't get ahead of them:
+            await sf_db.flush_buffer()
+            await sf_db.save_checkpoint(user_id, next_cursor, collected)
+
+    await run_pipeline(fetch_pages(), write_pages())
+
+    # Crawl finished, the next one starts from the first page again:
+    if checkpoint or ids_collected:
+        await sf_db.clear_checkpoint(user_id)
+
+    # Stop id_progress task:
+    id_progress.update(id_task, visible=False)
+    id_progress.stop_task(id_task)
+
+    # Output how many new follower ids we've found:
+    live.console.print(f"Total new ids found for {username}: {total_unique:,}\n")
+
+
+@with_api1_connection
+@log
+def api1_get_followers_count(api, user_id: int) -> int:
+    """Current follower count of <user_id>. It is looked up with
+    `lookup_users`, so the caller can charge it to `lookup_bucket` and pass
+    the account that bucket picked as `api`."""
+    return api.lookup_users(user_id=[user_id])[0].followers_count
+
+
+@log
+async def api1_diff_follower_ids(
+        user_data: Union[User, List[dict]],
+        just_ids: bool = True
+) -> None:
+    """Incremental crawl: compares the follower ids of the user in <user_data>
+    with their followers in `users_followers`, which are the snapshot left by
+    the previous crawl.
+
+    `get_follower_ids` returns the newest followers first, so new ones come
+    at the top of the list. Like in `api1_get_follower_ids`, pages are
+    fetched and written by a pipeline: each page is merged against the
+    sorted known ids as it arrives, known ids found are ticked off in a
+    bitmap (one byte per known follower), and only the new ones are handed
+    to `flush_ids`. Once `INCREMENTAL_STOP_IDS` known ids in a row have been
+    seen and the user's current follower count equals the known followers
+    plus the new ones, nobody can have unfollowed, so paging stops there.
+    Otherwise the whole list is paged and the known followers never ticked
+    off have their join moved to `users_followers_history`.
+
+    Users without any recorded followers get a regular crawl instead
+    (`api1_get_follower_ids`). Incremental crawls aren't checkpointed, and
+    a finished one clears the checkpoint of any interrupted regular crawl,
+    which would otherwise resume from a cursor this crawl has moved past.
+
+    Args:
+        user_data (Union): as for `api1_get_follower_ids`.
+        just_ids (bool): as for `api1_get_follower_ids`.
+    """
+    if isinstance(user_data, list):
+        username = user_data[0]["screen_name"]
+        user_id = user_data[0]["user_id"]
+    else:
+        username = user_data.screen_name
+        user_id = user_data.id
+    loop = asyncio.get_running_loop()
+    known: IdSet = await sf_db.get_all_users_followers(user_id)
+    if not known:
+        await api1_get_follower_ids(user_data, just_ids=just_ids)
+        return
+    join_table_data, follower_table_data = None, None
+    if DEDUP_MODE == "client":
+        follower_table_data = await sf_db.async_copy_out_ids(table_name="followers")
+        # The joins are the known followers:
+        join_table_data = known
+    # The count in <user_data> may come from the users table, so get it fresh.
+    # Without it (the lookup failed and was logged), the whole list is paged:
+    async with lookup_bucket.request() as api:
+        followers_count = await loop.run_in_executor(
+            executor, partial(api1_get_followers_count, user_id, api=api))
+
     id_task: TaskID = id_progress.add_task("follower ids", total=followers_count)
-    with live:
-        # Initialize set for holding total unique ids found during session:
-        total_unique_ids = set()
-        # Initialize set to hold ids until rate limit or total
-        # for this user (if total < rate limit):
-        temp_collection = set()
-
-        # Check rate limit:
-        rate_limit, reset_time = get_rate_limit(query="ids")
-        if not rate_limit:
-            await sleep_track(reset_time)
-            # Get new status:
-            rate_limit, reset_time = get_rate_limit(query="ids")
-
-        live.console.print(f"[green]{username}[/]: {followers_count:,} followers")
-        live.console.print("Executing `[yellow]get_follower_ids[/]` query...")
-        # Iterate through follower ids:
-        for follower in tweepy.Cursor(
-                api.get_follower_ids, screen_name=username, count=5_000
-        ).items():
-            # Add follower's id to unfiltered set:
-            temp_collection.add(follower)
-            # Track with rate limit:
-            rate_limit -= 1
-            if not rate_limit:
-                # Filter out duplicate ids:
-                unique_ids = temp_collection.difference(follower_table_data)
-                unique_joins = temp_collection.difference(join_table_data)
-                # Add new unique follower ids to total_unique_ids
-                total_unique_ids = total_unique_ids.union(unique_ids)
-                # Handle unique ids:
-                if not just_ids and unique_ids:
-                    live.console.print(
-                        f"Found {len(unique_ids):,} unique follower ids and {len(unique_joins):,} unique "
-                        f"joins\nExecuting `[yellow]lookup_users[/]` query on follower ids while waiting for rate "
-                        f"limit to reset.")
-                    # Pass unique ids to `lookup_users` process:
-                    await api1_lookup_users(user_id, unique_ids, unique_joins)
-                elif unique_ids:
-                    live.console.print(
-                        f"Found {len(unique_ids):,} unique follower ids\nWhile waiting for rate limit to reset, "
-                        "entering follower ids into database...")
-                    # Pass unique ids to process for database entry:
-                    process_ids(user_id, unique_ids, True)
-
-                # Get new rate limit status:
-                rate_limit, reset_time = get_rate_limit(query="ids")
-                if not rate_limit:
-                    # Create task for sleep_progress bar:
-                    await sleep_track(reset_time)
-                    # Get new rate limit status:
-                    rate_limit, reset_time = get_rate_limit(query="ids")
-
-                # Empty set:
-                temp_collection = set()
-
-            # Update progress bar:
-            id_progress.update(id_task, advance=1)
-
-        # Handle any remaining ids:
-        if temp_collection:
-            # Filter out duplicate ids:
-            unique_ids = temp_collection.difference(follower_table_data)
-            unique_joins = temp_collection.difference(join_table_data)
-            # Add new unique follower ids to total_unique_ids
-            total_unique_ids = total_unique_ids.union(unique_ids)
-            # Handle unique ids:
-            if not just_ids and (unique_ids or unique_joins):
-                if not unique_ids:
-                    process_ids(user_id, unique_ids, False)
+    live.console.print(
+        f"[green]{username}[/]: {followers_count or 0:,} followers, {len(known):,} known from the last crawl")
+    live.console.print("Executing `[yellow]get_follower_ids[/]` query...")
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_PAGES)
+    # Known followers found in this crawl, by their index in <known>:
+    seen = bytearray(len(known))
+    ids_paged = 0
+    total_added = 0
+    stopped_early = False
+
+    async def fetch_pages() -> None:
+        """Producer: pages through the follower ids and queues each page with
+        the positions of its ids in <known>, until the end of the list or
+        until nothing further down can have changed."""
+        nonlocal ids_paged, total_added, stopped_early
+        cancelled = False
+        known_run = 0
+        next_cursor = -1
+        try:
+            while next_cursor != 0:
+                async with ids_bucket.request() as api:
+                    page, next_cursor = await loop.run_in_executor(executor, partial(
+                        api1_get_follower_ids_page, api, next_cursor, user_id=user_id))
+                if not page:
+                    break
+                ids_paged += len(page)
+                id_progress.update(id_task, advance=len(page))
+                positions = known.positions(page)
+                for position in positions:
+                    if position >= 0:
+                        known_run += 1
+                    else:
+                        known_run = 0
+                        total_added += 1
+                await page_queue.put((page, positions))
+                if known_run >= INCREMENTAL_STOP_IDS and followers_count == len(known) + total_added:
+                    stopped_early = True
+                    break
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                await page_queue.put(None)
+
+    async def write_pages() -> None:
+        """Consumer: ticks the known ids of each page off in <seen> and hands
+        the new ones to `flush_ids`."""
+        while True:
+            item = await page_queue.get()
+            if item is None:
+                return
+            page, positions = item
+            added = []
+            for _id, position in zip(page, positions):
+                if position >= 0:
+                    seen[position] = 1
                 else:
-                    live.console.print(
-                        f"Found {len(unique_ids):,} unique follower ids and {len(unique_joins):,} unique "
-                        f"joins\nExecuting `[yellow]lookup_users[/]` query on follower ids...")
-                    await api1_lookup_users(user_id, unique_ids, unique_joins)
-            elif unique_ids:
-                live.console.print(f"Found {len(unique_ids):,} unique follower ids\nEntering ids into database...")
-                process_ids(user_id, unique_ids, True)
+                    added.append(_id)
+            if added:
+                await flush_ids(user_id, added, just_ids, follower_table_data, join_table_data)
 
-        # Stop id_progress task:
-        id_progress.update(id_task, visible=False)
-        id_progress.stop_task(id_task)
+    await run_pipeline(fetch_pages(), write_pages())
 
-        # Output how many new follower ids we've found:
-        live.console.print(f"Total new ids found for {username}: {len(total_unique_ids):,}\n")
+    removed = set()
+    if not stopped_early:
+        unfollowed = IdSet.from_sorted(array("q", (_id for _id, hit in zip(known, seen) if not hit)))
+        removed = await sf_db.async_close_joins(user_id, unfollowed)
+    await sf_db.clear_checkpoint(user_id)
+    metrics.incr("tweeasy_follower_changes_total", total_added, change="added")
+    metrics.incr("tweeasy_follower_changes_total", len(removed), change="removed")
+
+    id_progress.update(id_task, visible=False)
+    id_progress.stop_task(id_task)
+    stop = f"stopped after {ids_paged:,} ids" if stopped_early else "full list checked"
+    live.console.print(
+        f"{username}: {total_added:,} new followers, {len(removed):,} unfollows ({stop})\n")
+
+
+@log
+async def refill_followers2_bucket() -> Tuple[int, tweepy.Client]:
+    """Refill for `followers2_bucket`: returns the number of
+    `get_users_followers` requests left in the current window of the account
+    with the most quota, and that account's v2 client. Windows no response
+    has been seen for yet count as full. Sleeps until a window resets if no
+    account has any left."""
+    while True:
+        windows = []
+        for client in api2_clients():
+            window = rate_limits_for(client).get(API2_FOLLOWERS_ENDPOINT)
+            windows.append((window or (API2_FOLLOWERS_LIMIT, int(time.time())), client))
+        (rate_limit, _), client = max(windows, key=lambda window: window[0][0])
+        if rate_limit:
+            return rate_limit, client
+        await sleep_track(max(min(window[0][1] for window in windows) - int(time.time()), 1))
+
+
+# Budget of v2 `get_users_followers` requests shared by every user being crawled:
+followers2_bucket = TokenBucket(refill_followers2_bucket)
+
+
+@with_api2_connection
+@log
+def api2_get_followers_page(client, user_id: int, pagination_token: Union[str, None] = None) -> tweepy.Response:
+    """Fetches one page of up to 1,000 followers of <user_id>, with the
+    fields in `API2_USER_FIELDS`.
+
+    Args:
+        client (tweepy.Client): supplied by decorator, or by the caller with
+        the `client` keyword argument.
+        user_id (int): Twitter id of the user whose followers are fetched.
+        pagination_token (str): `next_token` of the previous page, if any.
+    Returns:
+        tweepy.Response: followers in `data`, `next_token` in `meta`.
+    """
+    return client.get_users_followers(
+        user_id, max_results=1_000, pagination_token=pagination_token, user_fields=API2_USER_FIELDS)
+
+
+@log
+async def api2_get_followers(user_data: Union[User, List[dict]]) -> None:
+    """Collects the full follower data of the user in <user_data> with the v2
+    `get_users_followers` endpoint, which returns whole profiles, so unlike
+    `api1_get_follower_ids` no `lookup_users` query is needed.
+
+    Pages are fetched and written in the same producer/consumer pipeline.
+    Each batch of pages is filtered like in `flush_ids`: profiles of followers
+    not yet in `followers` (and, with `REFRESH_DAYS` set, stale ones) and the
+    joins not yet made go to the driver's write buffer. Requests are spread
+    from `followers2_bucket`, so they go to the account with the most quota
+    left, and an account that is rejected for going over its limit is
+    skipped until its window resets.
+
+    v2 pagination tokens don't fit `crawl_checkpoints`, so an interrupted
+    crawl starts from the first page again (already stored rows are filtered
+    out).
+
+    Args:
+        user_data (Union): as for `api1_get_follower_ids`.
+    """
+    if isinstance(user_data, list):
+        username = user_data[0]["screen_name"]
+        user_id = user_data[0]["user_id"]
+        followers_count = user_data[0]["followers_count"]
+    else:
+        username = user_data.screen_name
+        user_id = user_data.id
+        followers_count = user_data.followers_count
+    join_table_data, follower_table_data = None, None
+    if DEDUP_MODE == "client":
+        load_join_task = asyncio.create_task(sf_db.get_all_users_followers(user_id))
+        follower_table_data = await sf_db.async_copy_out_ids(table_name="followers")
+        join_table_data = await load_join_task
+
+    id_task: TaskID = id_progress.add_task("followers", total=followers_count)
+    total_unique = 0
+
+    live.console.print(f"[green]{username}[/]: {followers_count:,} followers")
+    live.console.print("Executing `[yellow]get_users_followers[/]` query...")
+    loop = asyncio.get_running_loop()
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_PAGES)
+
+    async def fetch_pages() -> None:
+        """Producer: pushes each page of followers onto the queue, then the
+        end-of-pages marker."""
+        pagination_token = None
+        cancelled = False
+        try:
+            while True:
+                try:
+                    async with followers2_bucket.request() as client:
+                        response = await loop.run_in_executor(executor, partial(
+                            api2_get_followers_page, user_id, pagination_token, client=client))
+                except tweepy.errors.TooManyRequests:
+                    # The account's window is recorded as spent now, so the
+                    # next request goes to the one with the most left:
+                    followers2_bucket.discard(client)
+                    continue
+                page = response.data or []
+                id_progress.update(id_task, advance=len(page))
+                await page_queue.put(page)
+                pagination_token = response.meta.get("next_token")
+                if pagination_token is None:
+                    break
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                await page_queue.put(None)
+
+    async def write_pages() -> None:
+        """Consumer: filters the queued pages (up to `WRITE_BATCH_PAGES` at a
+        time) and buffers their new profiles and joins."""
+        nonlocal total_unique
+        finished = False
+        while not finished:
+            page = await page_queue.get()
+            if page is None:
+                return
+            users = list(page)
+            while len(users) < WRITE_BATCH_PAGES * 1_000 and not page_queue.empty():
+                page = page_queue.get_nowait()
+                if page is None:
+                    finished = True
+                    break
+                users.extend(page)
+            ids = [user.id for user in users]
+            if DEDUP_MODE == "server":
+                unique_ids, unique_joins = await sf_db.async_filter_unique_ids(user_id, ids)
+            else:
+                batch = IdSet(ids)
+                unique_ids = batch.difference(follower_table_data)
+                unique_joins = batch.difference(join_table_data)
+            profile_ids = unique_ids
+            if REFRESH_DAYS > 0:
+                profile_ids = IdSet(unique_ids).union(await sf_db.async_filter_stale_ids(ids, REFRESH_DAYS))
+            total_unique += len(unique_ids)
+            profiles = [user for user in users if user.id in profile_ids]
+            if profiles:
+                rows = user_rows(profiles, adapt=user_row_v2)
+                await sf_db.buffer_lookup_users(rows)
+                # New followers whose profile couldn't be adapted won't be in
+                # the `followers` table, so they can't be joined:
+                unjoinable = IdSet(unique_ids).difference(row[0] for row in rows)
+                if unjoinable:
+                    unique_joins = IdSet(unique_joins).difference(unjoinable)
+            # Buffered after the profiles, so they are written first:
+            if unique_joins:
+                await sf_db.buffer_joins(user_id, unique_joins)
+
+    await run_pipeline(fetch_pages(), write_pages())
+
+    id_progress.update(id_task, visible=False)
+    id_progress.stop_task(id_task)
+    live.console.print(f"Total new followers found for {username}: {total_unique:,}\n")
+
+
+async def run_pipeline(producer: Coroutine, consumer: Coroutine) -> None:
+    """Runs a producer and a consumer that share a queue, until the consumer
+    has drained it. The producer must end by queueing an end marker.
+
+    If the consumer fails, the producer is cancelled (it may be waiting on a
+    full queue), and must then not queue the end marker. If the producer
+    fails, the consumer still drains what was already queued before the
+    error is raised. Either way both tasks have finished when this returns
+    or raises.
+    """
+    producer_task = asyncio.create_task(producer)
+    consumer_task = asyncio.create_task(consumer)
+    try:
+        await asyncio.wait({producer_task, consumer_task}, return_when=asyncio.FIRST_EXCEPTION)
+        if consumer_task.done() and consumer_task.exception():
+            producer_task.cancel()
+        await consumer_task
+        await producer_task
+    except BaseException:
+        producer_task.cancel()
+        consumer_task.cancel()
+        # Wait for the cancelled tasks to wind down, so none is left pending
+        # with an unretrieved exception:
+        await asyncio.gather(producer_task, consumer_task, return_exceptions=True)
+        raise
+
+
+@log
+async def flush_ids(
+        user_id: int,
+        collection: List[int],
+        just_ids: bool,
+        follower_table_data: Union[IdSet, None] = None,
+        join_table_data: Union[IdSet, None] = None
+) -> Union[Set[int], IdSet]:
+    """Filters pages of collected follower ids down to those not already in
+    the `followers` table and those not already joined to <user_id>, then
+    either enters them into the database or passes them to `lookup_users`.
+
+    With `DEDUP_MODE == "server"` the filtering happens in the database (and,
+    if `just_ids`, so do the inserts), otherwise against the pre-loaded sets.
+    With `REFRESH_DAYS` set, followers with stale profiles are passed to
+    `lookup_users` as well.
+
+    Args:
+        user_id (int): Twitter id of the user the followers belong to.
+        collection (List[int]): pages of collected follower ids.
+        just_ids (bool): whether only ids are entered or `lookup_users` is run.
+        follower_table_data (IdSet): pre-existing `followers` ids (client mode).
+        join_table_data (IdSet): pre-existing joins for <user_id> (client mode).
+    Returns:
+        Union[Set[int], IdSet]: the follower ids that were new to the `followers` table.
+    """
+    if DEDUP_MODE == "server" and just_ids:
+        unique_ids, unique_joins = await sf_db.async_copy_in_dedup_ids(user_id, collection)
+        live.console.print(
+            f"Entered {len(unique_ids):,} unique follower ids and {len(unique_joins):,} unique joins into database")
+        return unique_ids
+
+    if DEDUP_MODE == "server":
+        unique_ids, unique_joins = await sf_db.async_filter_unique_ids(user_id, collection)
+    else:
+        # Both filters are a single batched probe of the sorted id arrays:
+        batch = IdSet(collection)
+        unique_ids = batch.difference(follower_table_data)
+        unique_joins = batch.difference(join_table_data)
+
+    lookup_ids = unique_ids
+    if not just_ids and REFRESH_DAYS > 0:
+        stale_ids = await sf_db.async_filter_stale_ids(collection, REFRESH_DAYS)
+        if stale_ids:
+            live.console.print(f"Found {len(stale_ids):,} follower profiles to refresh")
+            # Stale followers are already in the table, so they can be joined
+            # straight away; the lookup only refreshes their profiles:
+            await sf_db.buffer_joins(user_id, unique_joins.intersection(stale_ids))
+            unique_joins = unique_joins.difference(stale_ids)
+            lookup_ids = unique_ids.union(stale_ids)
+
+    if not just_ids and lookup_ids:
+        live.console.print(
+            f"Found {len(unique_ids):,} unique follower ids and {len(unique_joins):,} unique "
+            f"joins\nExecuting `[yellow]lookup_users[/]` query on follower ids...")
+        # Pass unique (and stale) ids to `lookup_users` process:
+        await api1_lookup_users(user_id, lookup_ids, unique_joins)
+    elif not just_ids and unique_joins:
+        # Followers already exist, so they only need joining to user:
+        await sf_db.buffer_joins(user_id, unique_joins)
+    elif unique_ids:
+        live.console.print(f"Found {len(unique_ids):,} unique follower ids\nEntering ids into database...")
+        # Pass unique ids to process for database entry:
+        await process_ids(user_id, unique_ids, True)
+    return unique_ids
+
+
+@log
+async def refill_ids_bucket() -> Tuple[int, tweepy.API]:
+    """Refill for `ids_bucket`: returns the number of `get_follower_ids`
+    pages left in the current window of the account with the most quota,
+    and that account's client. Sleeps until a window resets if no account
+    has any left."""
+    api, rate_limit, reset_time = await pick_api(query="ids")
+    logger.info(f"`ids` query rate_limit = {rate_limit}, reset_time: {reset_time}")
+    return rate_limit, api
+
+
+# Budget of `get_follower_ids` pages shared by every user being crawled:
+ids_bucket = TokenBucket(refill_ids_bucket)
+
+
+@log
+async def refill_lookup_bucket() -> Tuple[int, tweepy.API]:
+    """Refill for `lookup_bucket`: returns the number of `lookup_users`
+    requests left in the current window of the account with the most
+    quota, and that account's client. Sleeps until a window resets if no
+    account has any left."""
+    api, rate_limit, reset_time = await pick_api(query="lookup")
+    logger.info(f"`lookup` query rate_limit = {rate_limit}, reset_time: {reset_time}")
+    return rate_limit, api
+
+
+# Budget of `lookup_users` requests shared by every lookup in flight:
+lookup_bucket = TokenBucket(refill_lookup_bucket)
+
+
+@log
+async def lookup_hundred(hundred_ids: List[int]) -> List[User]:
+    """Profiles of up to 100 ids. Ids found in `lookup_cache` are served from
+    it; only the others are queried with `lookup_users`, which takes a token
+    from `lookup_bucket`. The profiles fetched are cached
+    before they are written, so if the write fails they aren't lost.
+
+    A small percentage of ids returned by `get_follower_ids` will 404 in
+    `lookup_users`. If the query fails that way, the ids are written to the
+    log so the problem can be filtered out later if desired, and only the
+    cached profiles are returned."""
+    loop = asyncio.get_running_loop()
+    cached = {}
+    if lookup_cache is not None:
+        cached = await loop.run_in_executor(executor, lookup_cache.get_many, hundred_ids)
+    users: List[User] = []
+    for profile, fetched in cached.values():
+        user = User.parse(api1_clients()[0], profile)
+        # Written as `collected`, so the profile goes stale from when it was fetched:
+        user.collected = datetime.datetime.fromtimestamp(fetched, datetime.timezone.utc)
+        users.append(user)
+    missing = [_id for _id in hundred_ids if _id not in cached]
+    if missing:
+        # Client of the account the request is charged to:
+        try:
+            async with lookup_bucket.request() as api:
+                fetched: List[User] = await loop.run_in_executor(
+                    executor, partial(api.lookup_users, user_id=missing))
+        except tweepy.errors.NotFound:
+            logger.error(
+                f"[404 ERROR] At least one of the following ids could not be found in `lookup_users` "
+                f"query:\n{missing}")
+            live.console.print("[bold red][404 ERROR][/] NotFound error encountered for some user ids. See call "
+                               "log for details.")
+            return users
+        if lookup_cache is not None:
+            await loop.run_in_executor(executor, lookup_cache.put_many, [user._json for user in fetched])
+        users.extend(fetched)
+    return users
+
+
+@log
+async def process_lookup_page(user_id: int, users_list: List[User], unique_joins: IdSet) -> None:
+    """Hands one `lookup_users` page to the write buffer, with the joins to
+    <user_id> of the followers on it that are in <unique_joins>. Followers
+    whose profile couldn't be adapted into a row aren't joined, as they
+    won't be in the `followers` table."""
+    rows = await process_lookup_users(users_list)
+    joins = unique_joins.intersection(row[0] for row in rows)
+    if joins:
+        await sf_db.buffer_joins(user_id, joins)
 
 
-@with_api1_connection
 @log
 async def api1_lookup_users(
-        api,
         user_id: int,
-        follower_ids: Set[int],
-        unique_joins: Set[int]
+        follower_ids: Union[Set[int], IdSet],
+        unique_joins: Union[Set[int], IdSet]
 ) -> None:
-    """Runs `lookup_users` query for 100 follower ids at a time. These
-    are immediately processed and entered into `followers` table and
-    `users_follower` table.
-
-    Rationale: Processing the results of the query 100 at a time is slightly
-    slower than adding them to a set and then processing only after we have
-    queried all ids, but there are two advantages to the former method:
+    """Runs `lookup_users` query for 100 follower ids at a time, with up to
+    `LOOKUP_CONCURRENCY` queries in flight. Each page is immediately processed
+    and entered into `followers` table and `users_follower` table.
+
+    The blocking tweepy calls run on `executor`, and each page goes to the
+    driver's write buffer, which COPYs pages in bulk rather than 100 rows at
+    a time.
+    Every query takes a token from `lookup_bucket`, which is shared by all
+    lookups and refilled from the account with the most quota left, so each
+    window is spent as fast as the API allows without going over it.
+    Profiles still in `lookup_cache`, e.g. from a run that failed before they
+    were written, cost no query at all.
+
+    Rationale: Processing the results of the query 100 at a time, rather than
+    adding them to a set and processing only after we have queried all ids,
+    has two advantages:
 
     (1) it allows us to narrow down accounts causing 404 errors and
     (2) it allows us to not requery account sets if we can't avoid other
-    errors like HTTP 500 or 503. (Making the former method faster than the
-    latter, were we to encounter those errors on larger sets.)
-
-    Additionally, in my own testing, the former method is still able to
-    completely query and process the maximum number of ids that it can be
-    passed from the `get_follower_ids` query before the api rate limit on
-    that query resets. Thus, even though slower, no time is lost in the
-    overall run-time when querying large sets of ids. For smaller sets,
-    the time difference becomes negligible (e.g., a difference of 30 seconds).
+    errors like HTTP 500 or 503.
 
     Args:
-        api (tweepy.api.API): supplied by decorator.
-
         user_id (int): Twitter id for <user_id> from prior api call
-        follower_ids (List[int]): Twitter ids of those following <user_id> that
+        follower_ids (Union[Set[int], IdSet]): Twitter ids of those following <user_id> that
         have not yet been entered into the `followers` table.
 
-        unique_joins (Set[int]): Twitter ids of those following <user_id> that
+        unique_joins (Union[Set[int], IdSet]): Twitter ids of those following <user_id> that
         have not yet been entered into the `users_followers` table.
     """
-    # TODO: Ensure rate limit calculation is accurate
     # Get number of follower ids to be processed:
     follower_count = len(follower_ids)
     # Convert follower_ids (set) to list:
     follower_ids = [_id for _id in follower_ids]
+    # Index of joins to make:
+    unique_joins = IdSet(unique_joins)
 
     # Set up rich progress task for query:
     lookup_task: TaskID = lookup_progress.add_task("lookup query", total=follower_count)
-    # Get rate limit status:
-    rate_limit, reset_time = get_rate_limit(query="lookup")
-    logger.debug(f"`lookup_users` query rate_limit = {rate_limit}, reset_time: {reset_time}")
-    if not rate_limit:
-        await sleep_track(reset_time)
-        # Get new status:
-        rate_limit, reset_time = get_rate_limit(query="lookup")
-        logger.debug(f"`lookup_users` query rate_limit = {rate_limit}, reset_time: {reset_time}")
-
-    range_param = int(follower_count / 100)
-    for i in range(range_param + 1):
-        end_loc = min((i + 1) * 100, follower_count)
-        # A small percentage of ids returned by `get_follower_ids` query
-        # will 404 when running `lookup_users` query. If such an error
-        # occurs in the set of hundred, we write the set to the log so that
-        # the problem can be filtered out later if desired:
-        try:
-            hundred_followers: List[User] = api.lookup_users(
-                user_id=follower_ids[i * 100: end_loc])
-            # Add hundred followers to followers table:
-            process_lookup_users(hundred_followers)
-            set_of_hundred = set(user.id for user in hundred_followers)
-            # Grab intersection of unique join ids and hundred followers:
-            joins_to_process: set = unique_joins.intersection(set_of_hundred)
-            # Process joins:
-            process_ids(user_id, joins_to_process, False)
-            # Filter out processed joins:
-            unique_joins = unique_joins.difference(joins_to_process)
-        except tweepy.errors.NotFound:
-            not_found_ids = follower_ids[i * 100: end_loc]
-            logger.error(
-                f"[404 ERROR] At least one of the following ids could not be found in `lookup_users` "
-                f"query:\n{not_found_ids}")
-            live.console.print("[bold red][404 ERROR][/] NotFound error encountered for some user ids. See call log "
-                               "for details.")
-        finally:
-            rate_limit -= 1
-
-            # if not rate_limit:
-            if not rate_limit:
-                # Sleep:
-                await sleep_track(reset_time)
-                # Check rate limit again:
-                rate_limit, reset_time = get_rate_limit(query="lookup")
-                logger.info(f"`lookup` query rate_limit = {rate_limit}, reset_time: {reset_time}")
-                if not rate_limit:
-                    live.console.print("[orange]lookup_users[/] query rate limit not yet reset. Sleeping...")
-                    await sleep_track(reset_time)
-                    # Get new status:
-                    rate_limit, reset_time = get_rate_limit(query="lookup")
-                    logger.info(
-                        f"`lookup` query rate_limit = {rate_limit}, reset_time: {reset_time}")
-
-            # Update lookup_task:
-            lookup_progress.update(lookup_task, advance=100)
-    # If we didn't add unique_joins to join table earlier, do so
-    # now:
+    # Start offsets of each hundred, shared by the workers below:
+    offsets = iter(range(0, follower_count, 100))
+
+    async def lookup_worker() -> None:
+        for start in offsets:
+            hundred_ids = follower_ids[start: start + 100]
+            try:
+                hundred_followers = await lookup_hundred(hundred_ids)
+                # Add hundred followers to followers table and process joins:
+                await process_lookup_page(user_id, hundred_followers, unique_joins)
+            finally:
+                # Update lookup_task:
+                lookup_progress.update(lookup_task, advance=len(hundred_ids))
+
+    workers = [asyncio.create_task(lookup_worker()) for _ in range(LOOKUP_CONCURRENCY)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Stop the other workers taking hundreds off `offsets`, and wait for
+        # them to wind down, as in `run_pipeline`:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+    # Joins of followers that were already in the `followers` table haven't
+    # been made yet. (Ids that were looked up but not returned can't be joined.)
+    unique_joins = unique_joins.difference(follower_ids)
     if unique_joins:
-        process_ids(user_id, unique_joins, False)
+        await sf_db.buffer_joins(user_id, unique_joins)
     # Hide & stop lookup_progress bar:
     lookup_progress.update(lookup_task, visible=False)
     lookup_progress.stop_task(lookup_task)
@@ -451,10 +1020,10 @@ async def follower_data_pipe(username: str, just_ids: bool = True) -> None:
     # with Live(progress_group) as live:
     live.console.print(f"\nProcessing [green]{username}[/]")
     start = time.perf_counter()
-    user_data, in_db = api1_get_user(username)
+    loop = asyncio.get_running_loop()
+    user_data, in_db = await loop.run_in_executor(executor, api1_get_user, username)
     if not in_db:
-        user_bytearr: bytearray = user_bytearray({user_data})
-        sf_db.copy_in_lookup_users("users", user_bytearr.decode())
+        await sf_db.async_copy_in_lookup_users("users", user_rows([user_data]))
 
     followers_count = user_data.followers_count if not isinstance(user_data, list) else user_data[0]["followers_count"]
 
@@ -464,17 +1033,57 @@ async def follower_data_pipe(username: str, just_ids: bool = True) -> None:
         # TODO: Reimplement check for pre-existing ids this so that we check database.
         
         # Grab the ids:
-        await api1_get_follower_ids(user_data, just_ids=True)
+        if INCREMENTAL:
+            await api1_diff_follower_ids(user_data, just_ids=True)
+        else:
+            await api1_get_follower_ids(user_data, just_ids=True)
         duration, units = format_time(time.perf_counter() - start)
         live.console.print(f"Duration: {duration} {units}")
 
     # Get full follower data:
     else:
-        await api1_get_follower_ids(user_data, just_ids=False)
+        try:
+            if CRAWL_ENGINE == "v2":
+                await api2_get_followers(user_data)
+            elif INCREMENTAL:
+                await api1_diff_follower_ids(user_data, just_ids=False)
+            else:
+                await api1_get_follower_ids(user_data, just_ids=False)
+        finally:
+            # Write out whatever lookups and joins are still buffered:
+            await sf_db.flush_buffer()
         duration, units = format_time(time.perf_counter() - start)
         live.console.print(f"Duration: {duration} {units}")
 
 
+@log
+async def crawl_users(username_list: List[str], just_ids: bool = True) -> None:
+    """Runs `follower_data_pipe` for up to `CRAWL_CONCURRENCY` users at once.
+
+    All users share `ids_bucket` and `lookup_bucket`, so while one user waits
+    for the ids window to reset, lookups for the others keep going (and vice
+    versa), keeping both rate limits busy across the whole list. A failure
+    for one user is logged and doesn't stop the others.
+
+    Args:
+        username_list (List[str]): names following the @ symbol of Twitter accounts.
+        just_ids (bool, optional): passed on to `follower_data_pipe`.
+    """
+    semaphore = asyncio.Semaphore(CRAWL_CONCURRENCY)
+
+    async def crawl(username: str) -> None:
+        async with semaphore:
+            await follower_data_pipe(username, just_ids=just_ids)
+
+    with live:
+        results = await asyncio.gather(
+            *(crawl(username) for username in username_list), return_exceptions=True)
+    for username, res in zip(username_list, results):
+        if isinstance(res, Exception):
+            logger.error(f"Crawl of {username} failed: {res!r}")
+            console.print(f"[bold red]Crawl of {username} failed:[/] {res}")
+
+
 @log
 async def selection_one():
     """For getting user data."""
@@ -495,23 +1104,22 @@ async def selection_one():
 async def selection_two():
     """For getting a user's follower data."""
     username = input("Enter the username: ")
-    await follower_data_pipe(username)
+    with live:
+        await follower_data_pipe(username)
 
 
 @log
 async def selection_three():
     """For getting full follower data by iterating over a list of users."""
     username_list = get_username_list()
-    for user in username_list:
-        await follower_data_pipe(user, just_ids=False)
+    await crawl_users(username_list, just_ids=False)
 
 
 @log
 async def selection_four():
     """For getting follower IDs by iterating over a list of users."""
     users_list = get_username_list()
-    for user in users_list:
-        await follower_data_pipe(user)
+    await crawl_users(users_list)
 
 
 @log
@@ -536,8 +1144,51 @@ async def selection_six():
         await sf_db.reset_all_tables()
 
 
+@log
+async def selection_eight():
+    """For exporting a table to a file in the data directory."""
+    table = input("Enter table to export: ")
+    file_format = input(f"Enter file format ({', '.join(EXPORT_FORMATS)}) [tsv.gz]: ") or "tsv.gz"
+    username = input("Enter a username to only export rows related to that user, or leave blank: ")
+    user_id = None
+    if username:
+        user_row = sf_db.get_known_user(username)
+        if user_row is None:
+            console.log(f"[bold red]{username} not found in `users` table[/bold red]")
+            return
+        user_id = user_row[0]["user_id"]
+    # Exporting can take a while, so it runs on the executor:
+    loop = asyncio.get_running_loop()
+    try:
+        path = await loop.run_in_executor(executor, sf_db.export_table, table, file_format, user_id)
+    except TableSpecifierError:
+        console.log(f"[bold red]`{table}` is not a table that can be exported[/bold red]")
+    except (ValueError, OSError, psycopg.Error) as e:
+        # Unknown format, a failed write or a database error:
+        logger.error(f"Export of {table} failed: {e!r}")
+        console.log(f"[bold red]Export of {table} failed:[/bold red] {e}")
+    else:
+        console.log(f"[green]{table}[/green] exported to {path}")
+
+
 @log
 async def main():
+    # Keep the metrics file up to date while queries run:
+    metrics_export = asyncio.create_task(metrics.export_periodically())
+    try:
+        await menu_loop()
+    finally:
+        metrics_export.cancel()
+        metrics.write()
+        if lookup_cache is not None:
+            lookup_cache.close()
+        # Close the kept-alive Twitter API connections:
+        close_clients()
+        # Close pooled database connections on the way out:
+        await DbC.close_pools()
+
+
+async def menu_loop():
     while True:
         print(Markdown(MENU))
         try:
@@ -560,6 +1211,8 @@ async def main():
             # results, without having msg obscure those results.
             if selection == 7:
                 sys.exit()
+            if selection == 8:
+                await selection_eight()
         except TypeError:
             print("Please enter a number")
         prompt = input("\nContinue? (y/n)\n").lower()
@@ -3,14 +3,43 @@
 # decorator functions for the Twitter api.
 #
 # It is assumed that credentials are set via environment
-# variables.
+# variables. Several accounts can be pooled by listing
+# their credentials in TWITTER_CREDENTIALS (JSON) or in a
+# JSON file at TWITTER_CREDENTIALS_FILE.
+#
+# Clients are created once per set of credentials and then
+# reused by every decorated call, so the underlying requests
+# session keeps its connections alive for the whole crawl.
+# tweepy's v1 client closes its session after every request,
+# so it is given one that ignores that; `close_clients`
+# closes the sessions on the way out.
 ############################################################
 import os
+import json
+import threading
+from typing import Dict, List, Union
+
+import requests
 import tweepy
 from rich.console import Console
 
+from utils.metrics import metrics
+from utils.rate_limiter import RateLimitTracker
+
 # Create rich console instance:
 console = Console()
+# Keep-alive connections held per host. Should be at least the number of
+# requests made concurrently from the executor threads:
+HTTP_POOL_MAXSIZE = 16
+
+# Registry of long-lived clients, keyed by credentials:
+_api1_clients: Dict[tuple, tweepy.API] = {}
+_api2_clients: Dict[str, tweepy.Client] = {}
+_clients_lock = threading.Lock()
+# Rate limit windows of each client, keyed by id(client):
+_rate_limits: Dict[int, RateLimitTracker] = {}
+# Loaded once by `twitter_credentials_pool`:
+_credentials_pool: List[dict] = []
 
 
 def twitter_credentials() -> dict:
@@ -27,19 +56,124 @@ def twitter_credentials() -> dict:
     }
 
 
+def twitter_credentials_pool() -> List[dict]:
+    """List of credential dictionaries (with the same keys as
+    `twitter_credentials`), one per account we can query with. Read once
+    from the JSON list in the TWITTER_CREDENTIALS environment variable or
+    the JSON file at TWITTER_CREDENTIALS_FILE; falls back to the single set
+    of credentials in the environment.
+    :return: list of dictionaries of credentials."""
+    global _credentials_pool
+    if not _credentials_pool:
+        if os.environ.get("TWITTER_CREDENTIALS"):
+            pool = json.loads(os.environ["TWITTER_CREDENTIALS"])
+        elif os.environ.get("TWITTER_CREDENTIALS_FILE"):
+            with open(os.environ["TWITTER_CREDENTIALS_FILE"], "r") as f:
+                pool = json.load(f)
+        else:
+            pool = [twitter_credentials()]
+        if not pool:
+            raise ValueError("The Twitter credentials pool is empty")
+        _credentials_pool = pool
+    return _credentials_pool
+
+
+class KeptSession(requests.Session):
+    """Session whose `close` does nothing, for `tweepy.API`, which closes
+    its session (dropping the pooled connections) at the end of every
+    request. `shutdown` really closes it."""
+
+    def close(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        super().close()
+
+
+def keep_alive(session: requests.Session) -> None:
+    """Mounts an adapter that keeps up to `HTTP_POOL_MAXSIZE` connections
+    alive, so concurrent requests don't open (and TLS handshake) new ones."""
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+
+
+def get_api1_client(params: dict) -> tweepy.API:
+    """Returns the shared Twitter API v1 client for <params>, creating it on
+    first call. Safe to call from several threads."""
+    key = (params["cons_key"], params["acc_token"])
+    with _clients_lock:
+        api = _api1_clients.get(key)
+        if api is None:
+            auth = tweepy.OAuthHandler(params["cons_key"], params["cons_sec"])
+            auth.set_access_token(params["acc_token"], params["acc_sec"])
+            api = tweepy.API(
+                auth,
+                retry_count=10,
+                retry_delay=60,
+                retry_errors=[443, 500, 503],
+                wait_on_rate_limit=True)
+            api.session = KeptSession()
+            keep_alive(api.session)
+            api.session.hooks["response"].append(metrics.count_response)
+            # Keep track of the rate limit headers of every response:
+            tracker = RateLimitTracker()
+            api.session.hooks["response"].append(tracker.record)
+            _rate_limits[id(api)] = tracker
+            _api1_clients[key] = api
+    return api
+
+
+def api1_clients() -> List[tweepy.API]:
+    """The shared v1 client of every account in the credentials pool."""
+    return [get_api1_client(params) for params in twitter_credentials_pool()]
+
+
+def close_clients() -> None:
+    """Closes the sessions of all shared clients, and their connections."""
+    with _clients_lock:
+        for api in _api1_clients.values():
+            api.session.shutdown()
+        for client in _api2_clients.values():
+            client.session.close()
+
+
+def rate_limits_for(api: Union[tweepy.API, tweepy.Client]) -> RateLimitTracker:
+    """The rate limit windows of <api>, a client from `get_api1_client` or
+    `get_api2_client`."""
+    return _rate_limits[id(api)]
+
+
+def get_api2_client(params: dict) -> tweepy.Client:
+    """Returns the shared Twitter API v2 client for <params>, creating it on
+    first call. Safe to call from several threads."""
+    key = params["bearer"]
+    with _clients_lock:
+        client = _api2_clients.get(key)
+        if client is None:
+            # Rate limits are handled by the caller, which can move on to
+            # another account instead of sleeping:
+            client = tweepy.Client(params["bearer"])
+            keep_alive(client.session)
+            client.session.hooks["response"].append(metrics.count_response)
+            tracker = RateLimitTracker()
+            client.session.hooks["response"].append(tracker.record)
+            _rate_limits[id(client)] = tracker
+            _api2_clients[key] = client
+    return client
+
+
+def api2_clients() -> List[tweepy.Client]:
+    """The shared v2 client of every account in the credentials pool."""
+    return [get_api2_client(params) for params in twitter_credentials_pool()]
+
+
 def with_api1_connection(func):
-    """Decorator for handling Twitter API v1 connection"""
-    params = twitter_credentials()
+    """Decorator for handling Twitter API v1 connection. Passes the shared
+    client of the first account in the credentials pool to function, unless
+    the caller picks one with the `api` keyword argument."""
 
     def wrapper(*args, **kwargs):
-        auth = tweepy.OAuthHandler(params["cons_key"], params["cons_sec"])
-        auth.set_access_token(params["acc_token"], params["acc_sec"])
-        api = tweepy.API(
-            auth,
-            retry_count=10,
-            retry_delay=60,
-            retry_errors=[443, 500, 503],
-            wait_on_rate_limit=True)
+        api = kwargs.pop("api", None) or get_api1_client(twitter_credentials_pool()[0])
         try:
             res = func(api, *args, **kwargs)
             return res
@@ -50,15 +184,18 @@ def with_api1_connection(func):
 
 
 def with_api2_connection(func):
-    """Decorator for handling Twitter API v2 connection"""
-    params = twitter_credentials()
+    """Decorator for handling Twitter API v2 connection. Passes the shared
+    client of the first account in the credentials pool to function, unless
+    the caller picks one with the `client` keyword argument. Errors are
+    logged and re-raised, so the caller can tell them apart."""
 
-    def wrapper(self, *args, **kwargs):
-        client = tweepy.Client(params["bearer"], wait_on_rate_limit=True)
+    def wrapper(*args, **kwargs):
+        client = kwargs.pop("client", None) or get_api2_client(twitter_credentials_pool()[0])
         try:
             res = func(client, *args, **kwargs)
+            return res
         except Exception as e:
             console.log(e)
-        return res
+            raise
 
     return wrapper
@@ -0,0 +1,88 @@
+############################################################
+# File writers for table exports.
+#
+# Rows are written as they are streamed out of Postgres, so
+# an export needs memory for one chunk (TSV) or one batch
+# of rows (Parquet), whatever the size of the table.
+#
+# zstd compression needs the `zstandard` package and Parquet
+# needs `pyarrow`. Neither is in the requirements, so those
+# formats are only offered when the package is installed.
+############################################################
+import gzip
+import json
+from typing import BinaryIO, List, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Formats that can be written with the packages installed:
+EXPORT_FORMATS = ("tsv", "tsv.gz") + (("tsv.zst",) if zstandard else ()) + (("parquet",) if pa else ())
+# Postgres type oids of json and jsonb, written to Parquet as strings:
+JSON_OIDS = (114, 3802)
+
+
+def open_tsv(path: str, compression: Union[str, None] = None) -> BinaryIO:
+    """Opens <path> for writing COPY text output, compressed with
+    <compression>: None, `gz` or `zst`."""
+    if compression == "gz":
+        return gzip.open(path, "wb", compresslevel=6)
+    if compression == "zst":
+        if zstandard is None:
+            raise ImportError("Exporting to .zst needs the `zstandard` package")
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+
+def _arrow_type(oid: int):
+    """Arrow type for a column of the Postgres type <oid>."""
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        701: pa.float64(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+    }.get(oid, pa.string())
+
+
+class ParquetRowWriter:
+    """Writes batches of rows to a Parquet file, one row group per batch.
+
+    :param path: file to write.
+    :param columns: (name, type oid) of each column, e.g. from
+    `UserFollowerDriver.export_columns`."""
+
+    def __init__(self, path: str, columns: List[Tuple[str, int]]):
+        if pa is None:
+            raise ImportError("Exporting to Parquet needs the `pyarrow` package")
+        self._json = [oid in JSON_OIDS for _, oid in columns]
+        self._schema = pa.schema([(name, _arrow_type(oid)) for name, oid in columns])
+        self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def write_rows(self, rows: List[tuple]) -> None:
+        arrays = []
+        for values, field, is_json in zip(zip(*rows), self._schema, self._json):
+            if is_json:
+                values = [None if value is None else json.dumps(value) for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def __enter__(self) -> "ParquetRowWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -1,19 +1,20 @@
-import json
 import datetime
 import logging
-from typing import Tuple
+from typing import Callable, Tuple, Optional, Iterable, List, Union
 
 import tweepy
+from psycopg.types.json import Json
 
 from utils.logger import log, log_setter
 
 log_setter(__name__, format="\t%(lineno)d - %(message)s")
 logger = logging.getLogger(__name__)
 
-# Initialize translation table:
-nul_table = str.maketrans(u"\x00", " ")
-trans_table = str.maketrans("""\r\n\t\\""", """    """)
-trans_table.update(nul_table)
+# Fields requested from the v2 API for `user_row_v2`:
+API2_USER_FIELDS = [
+    "created_at", "description", "entities", "location", "protected",
+    "public_metrics", "url", "verified", "withheld",
+]
 
 
 @log
@@ -29,40 +30,34 @@ def format_time(t: float) -> Tuple[float, str]:
     return round(t, 2), "sec"
 
 
-def format_attributes(user: tweepy.models.User) -> list:
-    # Format text fields:
-    name = user.name.translate(trans_table)
-    screen_name = user.screen_name.translate(trans_table)
-    location = user.location.translate(trans_table) if user.location else r"\N"
-    description = user.description.translate(
-        trans_table) if user.description else r"\N"
-    url = user.url.translate(trans_table) if user.url else r"\N"
+def clean_text(value: Optional[str]) -> Optional[str]:
+    """Adapter for TEXT columns. Postgres text can't hold NUL (0x00)
+    bytes, and empty values are stored as NULL."""
+    return value.replace("\x00", "") if value else None
 
-    # Format json fields:
-    entities = str(user.entities).replace('"', "'")
-    entities = entities.replace("'{", "E'{")
-    entities = entities.translate(trans_table)
+
+def to_json(value) -> Optional[Json]:
+    """Adapter for JSON columns."""
+    return Json(value) if value is not None else None
+
+
+def user_row(user: tweepy.models.User) -> tuple:
+    """Adapts a tweepy User into a row for `users`/`followers`, in the
+    column order of `pg_sql.copy_in_lookup_users`. Escaping of tabs,
+    newlines and backslashes is left to psycopg's `Copy.write_row`.
+    `collected` is when the profile was fetched: the `collected` attribute
+    of users served from the lookup cache, otherwise now."""
     # Can't access status on protected accounts
-    try:
-        status = str(user.status._json).replace('"', "'")
-        status = status.replace("'{", "E'{")
-        status = status.translate(trans_table)
-        if "\\" in status:
-            status = status.replace("\\", " ")
-    except Exception as e:
-        status = {}
-
-    withheld_in_countries = user.withheld_in_countries if user.withheld_in_countries else r"\N"
-
-    # Return list of attributes:
-    return [
+    status = getattr(user, "status", None)
+    withheld_in_countries = user.withheld_in_countries if user.withheld_in_countries else None
+    return (
         user.id,
-        name,
-        screen_name,
-        location,
-        description,
-        url,
-        json.dumps(entities),
+        clean_text(user.name),
+        clean_text(user.screen_name),
+        clean_text(user.location),
+        clean_text(user.description),
+        clean_text(user.url),
+        to_json(user.entities),
         user.protected,
         user.followers_count,
         user.friends_count,
@@ -71,51 +66,63 @@ def format_attributes(user: tweepy.models.User) -> list:
         user.favourites_count,
         user.verified,
         user.statuses_count,
-        json.dumps(status),
-        withheld_in_countries,
-        datetime.datetime.now()
-    ]
+        to_json(status._json if status is not None else None),
+        str(withheld_in_countries) if withheld_in_countries else None,
+        getattr(user, "collected", None) or datetime.datetime.now(datetime.timezone.utc),
+    )
+
+
+def user_row_v2(user: tweepy.User) -> tuple:
+    """Adapts a v2 tweepy User (requested with `API2_USER_FIELDS`) into a
+    row for `users`/`followers`, like `user_row`. The v2 API has no
+    favourites count or latest status, so those columns are left empty."""
+    counts = user.public_metrics or {}
+    withheld_in_countries = (user.withheld or {}).get("country_codes")
+    return (
+        user.id,
+        clean_text(user.name),
+        clean_text(user.username),
+        clean_text(user.location),
+        clean_text(user.description),
+        clean_text(user.url),
+        to_json(user.entities),
+        user.protected,
+        counts.get("followers_count"),
+        counts.get("following_count"),
+        counts.get("listed_count"),
+        user.created_at,
+        None,
+        user.verified,
+        counts.get("tweet_count"),
+        None,
+        str(withheld_in_countries) if withheld_in_countries else None,
+        datetime.datetime.now(datetime.timezone.utc),
+    )
 
 
 @log
-def user_bytearray(users_set: set, ids_exist: bool = False) -> bytearray:
-    users_bytearr = bytearray("", "utf-8")
+def user_rows(
+        users: Iterable[Union[tweepy.models.User, tweepy.User]],
+        adapt: Callable[..., tuple] = user_row
+) -> List[tuple]:
+    """Adapts tweepy Users into rows for `Copy.write_row`, with <adapt>
+    (`user_row_v2` for v2 Users). Users that can't be adapted are logged
+    and skipped."""
+    rows = []
     skipped = 0
-    for user in users_set:
-        attr_list = format_attributes(user)
-
-        if ids_exist:
-            attr_list.pop(0)
-        
-        # We set up a variable for the specific user
-        # so that we can check for any problems that
-        # might arise from fromatting errors related
-        # to unicode or escape characters:
-        user_bytearr = bytearray("", "utf-8")
-
-        for idx, attr in enumerate(attr_list):
-            # Each attribute represents a column, marked by tab. if last 
-            # attribute of User, we want it marked with new-line char:
-            if idx != len(attr_list) - 1:  # If not on last attribute:
-                user_bytearr += bytearray(str(attr) + "\t", "utf-8")
-            else:  # On last attribute:
-                user_bytearr += bytearray(str(attr) + "\n", "utf-8")
-
-        # Once we've created a bytearray for a specific user, we
-        # double check the number of attributes before adding user 
-        # to users_bytearr:
-        if len(user_bytearr.decode().split("\t")) != 18:
+    for user in users:
+        try:
+            rows.append(adapt(user))
+        except (AttributeError, TypeError, ValueError):
             skipped += 1
             log_file = "./src/data/formatters_warning.log"
             log_setter(__name__, file_name=log_file)
             formatters_log = logging.getLogger(__name__)
             formatters_log.warning(f"Problem formatting user with twitter id \
-                {user.id}. Skipped copying this user into database.")
-        else:
-            users_bytearr += user_bytearr            
+                {getattr(user, 'id', None)}. Skipped copying this user into database.")
 
     if skipped:
-        print(f"Skipped {skipped} users. See formatters_log.log in the \
+        print(f"Skipped {skipped} users. See formatters_warning.log in the \
             data directory for details.")
 
-    return users_bytearr
+    return rows
@@ -1,5 +1,15 @@
+import os
+import time
+import asyncio
 import logging
 import datetime
+import functools
+
+from utils.metrics import metrics
+
+# Write a line to `call_log.log` for every decorated call. Off by default,
+# since it costs two synchronous file writes per call:
+TRACE_CALLS = os.environ.get("TWEEASY_TRACE_CALLS", "0") not in ("", "0")
 
 
 def log_setter(
@@ -21,15 +31,43 @@ logger = logging.getLogger(__name__)
 
 
 def log(func):
+    """Records the call count and latency of <func> in `metrics`. If
+    TWEEASY_TRACE_CALLS is set, every call is also traced in the call log."""
+    name = f"{func.__module__}.{func.__qualname__}"
     # Offset for eastern time
     offset = datetime.timedelta(hours=-5)
 
-    def wrapper(*args, **kwargs):
+    def trace() -> None:
         called_at = datetime.datetime.now(datetime.timezone(offset))
         msg = f"{func.__name__}, {func.__module__}"
         logger.info(msg + " " * (80 - len(msg)) + f"[{called_at}]")
-        res = func(*args, **kwargs)
-        logger.info("")
-        return res
+
+    if asyncio.iscoroutinefunction(func):
+        # Time the coroutine itself, not just its creation:
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if TRACE_CALLS:
+                trace()
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+                if TRACE_CALLS:
+                    logger.info("")
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if TRACE_CALLS:
+            trace()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe(name, time.perf_counter() - start)
+            if TRACE_CALLS:
+                logger.info("")
 
     return wrapper
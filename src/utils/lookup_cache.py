@@ -0,0 +1,107 @@
+############################################################
+# On-disk cache of `lookup_users` responses.
+#
+# Profiles are stored in a local SQLite file, keyed by user
+# id, as soon as they are fetched and before they go to the
+# database. A re-run, or the replay of a batch that failed
+# to be written, takes them from here instead of spending
+# `/users/lookup` quota again.
+#
+# Entries expire after `LOOKUP_CACHE_TTL` hours and the
+# oldest are evicted once there are more than
+# `LOOKUP_CACHE_MAX_ENTRIES`.
+############################################################
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from utils.metrics import metrics
+
+# SQLite file of the cache. Empty turns the cache off:
+LOOKUP_CACHE_FILE = os.environ.get("TWEEASY_LOOKUP_CACHE", "./src/data/lookup_cache.sqlite3")
+# Hours a cached profile is used for:
+LOOKUP_CACHE_TTL = float(os.environ.get("TWEEASY_LOOKUP_CACHE_TTL", 72))
+# Most profiles kept; the oldest are evicted beyond that:
+LOOKUP_CACHE_MAX_ENTRIES = int(os.environ.get("TWEEASY_LOOKUP_CACHE_MAX", 2_000_000))
+# Profiles written between two eviction passes:
+EVICT_EVERY = 10_000
+
+
+class LookupCache:
+    """Cache of `lookup_users` profiles (the `_json` of tweepy `User`s).
+    Safe to use from several threads; calls are serialised on one
+    connection.
+
+    :param path: SQLite file, created if it doesn't exist.
+    :param ttl: hours a profile is used for.
+    :param max_entries: most profiles kept."""
+
+    def __init__(
+            self,
+            path: str = LOOKUP_CACHE_FILE,
+            ttl: float = LOOKUP_CACHE_TTL,
+            max_entries: int = LOOKUP_CACHE_MAX_ENTRIES
+    ):
+        self.ttl = ttl * 3600
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._written = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL;")
+        self._conn.execute("PRAGMA synchronous = NORMAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS profiles (
+                user_id INTEGER PRIMARY KEY,
+                fetched REAL NOT NULL,
+                payload TEXT NOT NULL
+            );""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS profiles_fetched_idx ON profiles (fetched);")
+
+    def get_many(self, user_ids: List[int]) -> Dict[int, Tuple[dict, float]]:
+        """Cached, unexpired profiles of <user_ids>, by id, each with the
+        time (epoch seconds) it was fetched. At most 100 ids at a time, as
+        for `lookup_users`."""
+        if not user_ids:
+            return {}
+        placeholders = ", ".join("?" * len(user_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT user_id, payload, fetched FROM profiles WHERE user_id IN ({placeholders}) AND fetched >= ?;",
+                (*user_ids, time.time() - self.ttl),
+            ).fetchall()
+        metrics.incr("tweeasy_lookup_cache_total", len(rows), result="hit")
+        metrics.incr("tweeasy_lookup_cache_total", len(user_ids) - len(rows), result="miss")
+        return {user_id: (json.loads(payload), fetched) for user_id, payload, fetched in rows}
+
+    def put_many(self, profiles: Iterable[dict]) -> None:
+        """Stores <profiles> (with their `id`), replacing older copies."""
+        now = time.time()
+        rows = [(profile["id"], now, json.dumps(profile)) for profile in profiles]
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO profiles (user_id, fetched, payload) VALUES (?, ?, ?);", rows)
+            self._written += len(rows)
+            if self._written >= EVICT_EVERY:
+                self._written = 0
+                self._evict()
+
+    def _evict(self) -> None:
+        """Deletes expired profiles, then the oldest ones beyond `max_entries`.
+        Called with the lock held."""
+        with self._conn:
+            self._conn.execute("DELETE FROM profiles WHERE fetched < ?;", (time.time() - self.ttl,))
+            excess = self._conn.execute("SELECT COUNT(*) FROM profiles;").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM profiles WHERE user_id IN "
+                    "(SELECT user_id FROM profiles ORDER BY fetched LIMIT ?);", (excess,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
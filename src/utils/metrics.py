@@ -0,0 +1,120 @@
+############################################################
+# In-memory metrics for the hot paths.
+#
+# Call counts and latencies of the functions wrapped by
+# `logger.log`, plus counters for rows written, API calls
+# made and bytes COPYd, are kept in process. Recording one
+# is a dict update under a lock, instead of the file writes
+# of the call trace. The whole lot is written out every so
+# often as a Prometheus text file (e.g. for node_exporter's
+# textfile collector, or just to read).
+############################################################
+import os
+import asyncio
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, Tuple
+
+from utils.rate_limiter import endpoint_from_url
+
+# Where `Metrics.write` puts the Prometheus text file:
+METRICS_FILE = os.environ.get("TWEEASY_METRICS_FILE", "./src/data/metrics.prom")
+# Seconds between writes of the metrics file while a query runs:
+METRICS_INTERVAL = float(os.environ.get("TWEEASY_METRICS_INTERVAL", 15))
+# Latest latencies kept per function to compute the quantiles from:
+SAMPLES_PER_FUNCTION = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple) -> str:
+    """Formats ((key, value), ...) as a Prometheus label set."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Counters and latency summaries. Thread-safe, since blocking calls
+    run on executor threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value:
+        self._counters: Dict[Tuple[str, tuple], float] = defaultdict(float)
+        # function -> calls, total seconds and latest latencies:
+        self._calls: Dict[str, int] = defaultdict(int)
+        self._seconds: Dict[str, float] = defaultdict(float)
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        """Adds <value> to counter <name>, e.g.
+        `incr("tweeasy_rows_written_total", 100, table="followers")`."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, function: str, seconds: float) -> None:
+        """Records one call of <function> that took <seconds>."""
+        with self._lock:
+            self._calls[function] += 1
+            self._seconds[function] += seconds
+            samples = self._samples.get(function)
+            if samples is None:
+                samples = self._samples[function] = deque(maxlen=SAMPLES_PER_FUNCTION)
+            samples.append(seconds)
+
+    def count_response(self, response, *args, **kwargs) -> None:
+        """`requests` response hook counting API calls by endpoint and status.
+        Endpoints are named as by `rate_limiter.endpoint_from_url`, so ids in
+        the url don't make a new series per user."""
+        self.incr(
+            "tweeasy_api_calls_total",
+            endpoint=endpoint_from_url(response.url),
+            status=response.status_code)
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            calls = dict(self._calls)
+            seconds = dict(self._seconds)
+            samples = {function: sorted(values) for function, values in self._samples.items()}
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{name}{_labels(labels)} {value:g}")
+        if calls:
+            lines.append("# TYPE tweeasy_call_seconds summary")
+        for function in sorted(calls):
+            values = samples[function]
+            for quantile in QUANTILES:
+                value = values[min(int(quantile * len(values)), len(values) - 1)]
+                labels = _labels((("function", function), ("quantile", quantile)))
+                lines.append(f"tweeasy_call_seconds{labels} {value:.6f}")
+            labels = _labels((("function", function),))
+            lines.append(f"tweeasy_call_seconds_sum{labels} {seconds[function]:.6f}")
+            lines.append(f"tweeasy_call_seconds_count{labels} {calls[function]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str = METRICS_FILE) -> None:
+        """Writes the metrics to <path>. The file is replaced in one step,
+        so readers never see half of it."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    async def export_periodically(self, path: str = METRICS_FILE, interval: float = METRICS_INTERVAL) -> None:
+        """Writes the metrics to <path> every <interval> seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            self.write(path)
+
+
+metrics = Metrics()
@@ -0,0 +1,153 @@
+############################################################
+# Rate limiting helpers for the Twitter API.
+#
+# Twitter's v1.1 limits are fixed windows: a number of
+# requests per endpoint that resets every 15 minutes. A
+# TokenBucket holds what is left of the current window and
+# is shared by every coroutine calling that endpoint, so
+# several requests can be in flight without overspending.
+# Requests still in flight aren't in the headers yet, so
+# they are taken off each refill.
+#
+# A RateLimitTracker remembers the window of each endpoint
+# from the x-rate-limit-* headers Twitter sends back with
+# every response, so `rate_limit_status` (itself rate
+# limited) only has to be called when nothing is known.
+############################################################
+import asyncio
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """Shared request budget for one rate-limited endpoint.
+
+    The bucket starts empty. Whenever it runs out, `refill` is awaited
+    for the next budget; it is expected to sleep until a window resets
+    if nothing is left, and return the number of requests available
+    together with the owner of that budget (e.g. the API client of the
+    account whose window it is). Only one coroutine refills at a time;
+    the others wait for it.
+
+    The count returned by `refill` (e.g. from the x-rate-limit-remaining
+    header) doesn't include requests that are still in flight, so every
+    request must be handed back with `release` once its response is in.
+    Requests in flight for the owner are taken off each refill, and if
+    that leaves nothing, the bucket waits for one of them to finish before
+    refilling again. `request` does both."""
+
+    def __init__(self, refill: Callable[[], Awaitable[Tuple[int, Any]]]):
+        self._refill = refill
+        self._tokens = 0
+        self._owner = None
+        self._lock = asyncio.Lock()
+        # Requests taken but not yet released, per owner:
+        self._in_flight: Counter = Counter()
+        self._released = asyncio.Event()
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens
+
+    async def acquire(self) -> Any:
+        """Takes one request from the bucket, refilling it first if empty.
+        :return: the owner of the budget the request was taken from."""
+        async with self._lock:
+            while self._tokens <= 0:
+                tokens, owner = await self._refill()
+                tokens -= self._in_flight[owner]
+                if tokens <= 0:
+                    # The rest of the window is in flight; once a response
+                    # is in, the next refill will know more:
+                    self._released.clear()
+                    await self._released.wait()
+                    continue
+                self._tokens, self._owner = tokens, owner
+            self._tokens -= 1
+            self._in_flight[self._owner] += 1
+            return self._owner
+
+    def release(self, owner: Any) -> None:
+        """Hands back a request taken with `acquire`, once it has completed
+        (or failed)."""
+        self._in_flight[owner] -= 1
+        self._released.set()
+
+    def discard(self, owner: Any) -> None:
+        """Drops what is left of <owner>'s budget, e.g. after it was
+        rejected for going over the limit, so the next request refills."""
+        if self._owner is owner:
+            self._tokens = 0
+
+    @asynccontextmanager
+    async def request(self) -> AsyncIterator[Any]:
+        """`acquire` for the duration of the block, then `release`.
+        Yields the owner of the budget."""
+        owner = await self.acquire()
+        try:
+            yield owner
+        finally:
+            self.release(owner)
+
+
+def endpoint_from_url(url: str) -> str:
+    """Maps a v1.1 request url to the endpoint name used by
+    `rate_limit_status`. E.g., `https://api.twitter.com/1.1/followers/ids.json`
+    to `/followers/ids`. Ids in the path of v2 urls become `:id`, e.g.
+    `https://api.twitter.com/2/users/12/followers` to `/2/users/:id/followers`."""
+    path = urlparse(url).path
+    if path.startswith("/1.1"):
+        path = path[len("/1.1"):]
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    if path.startswith("/2/"):
+        path = "/2/" + "/".join(":id" if part.isdigit() else part for part in path[len("/2/"):].split("/"))
+    return path
+
+
+class RateLimitTracker:
+    """Latest known rate limit window per endpoint. Thread-safe, since
+    responses arrive on executor threads.
+
+    Register `record` as a `requests` response hook and every response
+    updates the window of its endpoint; `update_from_status` seeds all
+    endpoints at once from a `rate_limit_status` payload."""
+
+    def __init__(self):
+        # endpoint -> (limit, remaining, reset epoch seconds):
+        self._windows: Dict[str, Tuple[int, int, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, response, *args, **kwargs) -> None:
+        """`requests` response hook reading the x-rate-limit-* headers."""
+        headers = response.headers
+        try:
+            window = (
+                int(headers["x-rate-limit-limit"]),
+                int(headers["x-rate-limit-remaining"]),
+                int(headers["x-rate-limit-reset"]),
+            )
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self._windows[endpoint_from_url(response.url)] = window
+
+    def update_from_status(self, status: dict) -> None:
+        """Seeds every endpoint from an `API.rate_limit_status()` payload."""
+        with self._lock:
+            for family in status["resources"].values():
+                for endpoint, window in family.items():
+                    self._windows[endpoint] = (window["limit"], window["remaining"], window["reset"])
+
+    def get(self, endpoint: str) -> Optional[Tuple[int, int]]:
+        """Remaining requests and reset time (epoch seconds) of <endpoint>,
+        or None if it is unknown or the window it belongs to has expired."""
+        with self._lock:
+            window = self._windows.get(endpoint)
+        if window is None or window[2] <= time.time():
+            return None
+        return window[1], window[2]